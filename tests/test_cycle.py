@@ -1,3 +1,5 @@
+import asyncio
+
 import numpy as np
 from thunderq.waveforms.native import DC, Blank
 from thunderq.cycles.native.cycle import Cycle
@@ -7,7 +9,7 @@ from thunderq.experiment import Sweep1DExperiment
 
 from thunderq.helper.mock_devices import (mock_awg0)
 
-from utils import init_runtime, init_fixed_sequence
+from utils import init_runtime, init_fixed_sequence, init_double_buffered_sequence
 
 
 class TestCycle:
@@ -51,6 +53,22 @@ class TestCycle:
         def post_run(self):
             pass
 
+    class PlayedAmplitudeProcedure(Procedure):
+        _parameters = ["amp"]
+
+        def __init__(self, slice: Slice, channel):
+            super().__init__("PlayedAmplitude", "")
+            self.slice = slice
+            self.channel = channel
+            self.amp = 1
+
+        def pre_run(self):
+            self.slice.clear_waveform(self.channel)
+            self.slice.add_waveform(self.channel, DC(0.1e-6, self.amp))
+
+        def post_run(self):
+            return {"played_amp": self.channel.device.amplitude}
+
     class MyTestSweepCycle(Cycle):
         def __init__(self, runtime, slice_0, awg_0):
             super().__init__("Test Cycle", runtime.sequence)
@@ -90,9 +108,14 @@ class TestCycle:
 
         assert not cycle.procedures[0].has_update
 
+        version = cycle.procedures[0].version
+        assert cycle.procedures[0].params_changed_since(version) == []
+
         cycle.procedures[0].waveform = DC(0.1e-6, 2)
 
         assert cycle.procedures[0].has_update
+        assert cycle.procedures[0].version > version
+        assert cycle.procedures[0].params_changed_since(version) == ["waveform"]
 
     def test_procedure_result_retrieve(self):
         runtime = init_runtime()
@@ -108,6 +131,45 @@ class TestCycle:
         assert res["prefix_res1"] == 3333
         assert res["prefix_res2"] == 4444
 
+    def test_run_after_stop(self):
+        runtime = init_runtime()
+        sequence, slice0, slice1, slice2 = init_fixed_sequence(runtime)
+
+        cycle = Cycle("Test Cycle", sequence)
+        slice0.add_waveform(mock_awg0, DC(0.1e-6, 1))
+        cycle.run()
+        assert mock_awg0.device.running
+
+        cycle.stop_sequence()
+        assert not mock_awg0.device.running
+
+        # Same waveform again, the device holds it already but has to start again
+        slice0.clear_waveform(mock_awg0)
+        slice0.add_waveform(mock_awg0, DC(0.1e-6, 1))
+        cycle.run()
+        assert mock_awg0.device.running
+
+    def test_run_async(self):
+        runtime = init_runtime()
+        sequence, slice0, slice1, slice2 = init_fixed_sequence(runtime)
+
+        cycle = self.MyTestStackCycle(runtime, slice0, mock_awg0,
+                                      [(0.1e-6, 1), (0.1e-6, 2)])
+        cycle.add_procedure(self.DummyResultProcedure("prefix_"))
+        res = asyncio.run(cycle.run_async())
+
+        expected_waveform, _ = Blank(2.8e-6).concat(DC(0.1e-6, 1)) \
+            .concat(DC(0.1e-6, 2)) \
+            .normalized_sample(mock_awg0.device.sample_rate)
+
+        assert res["prefix_res1"] == 3333
+        assert mock_awg0.device.running
+        assert len(expected_waveform) == len(mock_awg0.device.raw_waveform)
+        assert (mock_awg0.device.raw_waveform == expected_waveform).all()
+
+        asyncio.run(cycle.stop_sequence_async())
+        assert not mock_awg0.device.running
+
     def test_sweep(self):
         runtime = init_runtime()
         sequence, slice0, slice1, slice2 = init_fixed_sequence(runtime)
@@ -128,3 +190,70 @@ class TestCycle:
 
         assert (res['prefix_res1'] == np.array([3333, 3334, 3335])).all()
 
+    def test_double_buffered_sweep(self, tmp_path):
+        runtime = init_runtime()
+        sequence, slice0, channel = init_double_buffered_sequence(runtime)
+
+        cycle = Cycle("Test Cycle", sequence)
+        cycle.proc = self.PlayedAmplitudeProcedure(slice0, channel)
+        cycle.add_procedure(cycle.proc)
+        test_experiment = Sweep1DExperiment(runtime, "Test Experiment", cycle,
+                                            save_path=str(tmp_path), double_buffered=True)
+
+        res = test_experiment.sweep(
+            scan_param="proc.amp",
+            points=np.array([1., 2., 3., 4.]),
+            result_name="played_amp"
+        )
+
+        # Each point is acquired while its own waveform plays
+        assert (res["played_amp"] == np.array([1, 2, 3, 4])).all()
+        assert channel.device.upload_count == 4
+
+    def test_pipelined_sweep(self, tmp_path):
+        runtime = init_runtime()
+        sequence, slice0, slice1, slice2 = init_fixed_sequence(runtime)
+
+        cycle = Cycle("Test Cycle", sequence)
+        cycle.proc = self.PlayedAmplitudeProcedure(slice0, mock_awg0)
+        cycle.add_procedure(cycle.proc)
+        test_experiment = Sweep1DExperiment(runtime, "Test Experiment", cycle,
+                                            save_path=str(tmp_path), pipelined=True)
+
+        res = test_experiment.sweep(
+            scan_param="proc.amp",
+            points=np.array([3., 2., 1., 4.]),
+            result_name="played_amp"
+        )
+
+        # Each point is acquired while its own waveform plays
+        assert (res["played_amp"] == np.array([3, 2, 1, 4])).all()
+
+    def test_waveform_bank_sweep(self, tmp_path):
+        runtime = init_runtime()
+        sequence, slice0, channel = init_double_buffered_sequence(runtime)
+
+        cycle = Cycle("Test Cycle", sequence)
+        cycle.proc = self.PlayedAmplitudeProcedure(slice0, channel)
+        cycle.add_procedure(cycle.proc)
+        test_experiment = Sweep1DExperiment(runtime, "Test Experiment", cycle,
+                                            save_path=str(tmp_path), waveform_bank=True)
+
+        res = test_experiment.sweep(
+            scan_param="proc.amp",
+            points=np.array([1., 2., 1., 3.]),
+            result_name="played_amp"
+        )
+
+        assert (res["played_amp"] == np.array([1, 2, 1, 3])).all()
+        # Equal waveforms share one entry
+        assert channel.device.upload_count == 3
+        assert len([slot for slot in channel.device.slots if slot is not None]) == 3
+
+        # Back to normal operation afterwards
+        cycle.proc.amp = 5
+        cycle.run()
+        expected_waveform, _ = Blank(0.9e-6).concat(DC(0.1e-6, 5)) \
+            .normalized_sample(channel.device.sample_rate)
+        assert channel.device.amplitude == 5
+        assert (channel.device.raw_waveform == expected_waveform).all()
@@ -1,8 +1,12 @@
 import pytest
 import numpy as np
-from thunderq.waveforms.native import DC, Blank
+from thunderq.waveforms.native import DC, Blank, default_sample_cache
+from thunderq.waveforms.native.waveform import (Waveform, Gaussian, SumWave, Cos, CalibratedIQ,
+                                                Real, Imag)
+from thunderq.helper.iq_calibration_container import IQCalibrationContainer
 from thunderq.sequencer.slices import PaddingPosition, FlexSlice, FixedLengthSlice, FixedSlice
-from utils import init_runtime, init_fixed_sequence, init_flex_sequence, init_nake_sequence, init_gate_sequence
+from utils import init_runtime, init_fixed_sequence, init_flex_sequence, init_nake_sequence, init_gate_sequence, \
+    init_double_buffered_sequence, init_fresh_gate_sequence, init_fresh_sequence, init_iq_sequence
 
 from thunderq.helper.mock_devices import (mock_awg0, mock_awg1, mock_awg2,
                                           mock_awg3, mock_awg6, mock_awg10,
@@ -155,6 +159,341 @@ class TestSequence:
         assert len(expected_waveform) == len(mock_awg0.device.raw_waveform)
         assert (mock_awg0.device.raw_waveform == expected_waveform).all()
 
+    def test_iq_channels_share_carrier(self, monkeypatch):
+        runtime = init_runtime()
+        sequence, slice0, channel_I, channel_Q = init_iq_sequence(runtime)
+        default_sample_cache.clear()
+
+        carrier_evaluations = []
+        cos_kernel = Cos._kernel
+        monkeypatch.setattr(Cos, "_kernel",
+                            lambda self, t: carrier_evaluations.append(len(t)) or cos_kernel(self, t))
+
+        IQ_cali = IQCalibrationContainer(I_amp_factor=0.9, Q_amp_factor=1.1)
+        iq = CalibratedIQ(50e6, I_waveform=Gaussian(0.2e-6, 0.5), Q_waveform=DC(0.2e-6, 0.3),
+                          IQ_cali=IQ_cali)
+        slice0.add_waveform(channel_I, Real(iq))
+        slice0.add_waveform(channel_Q, Imag(iq))
+        sequence.setup()
+        sequence.run_channels()
+
+        # One pass over the carrier for both channels
+        assert carrier_evaluations == [200]
+
+        times = np.arange(0, 0.2e-6, 1e-9)
+        for channel, expected in ((channel_I, Real(iq).at_array(times)),
+                                  (channel_Q, Imag(iq).at_array(times))):
+            data = channel.device.raw_waveform * channel.device.raw_waveform_amp
+            assert len(data) == 1000
+            assert (data[:800] == 0).all()
+            assert np.allclose(data[800:], expected)
+
+    def test_fixed_slice_shift(self):
+        runtime = init_runtime()
+        sequence, slice0, slice1, slice2 = init_fixed_sequence(runtime)
+
+        slice1.add_waveform(mock_awg1, Gaussian(0.1e-6, 1))
+        slice2.add_waveform(mock_awg1, DC(0.1e-6, 0.5))
+
+        sequence.setup_trigger()
+        sequence.setup_channels()
+        sequence.run_channels()
+
+        sampled = []
+        sample_range = Waveform.sample_range
+
+        def record_sample_range(waveform, sample_rate, first, last, out=None):
+            sampled.append(last - first)
+            return sample_range(waveform, sample_rate, first, last, out)
+
+        Waveform.sample_range = record_sample_range
+        try:
+            slice1.start_from = 0.7e-6
+            sequence.setup_channels()
+            sequence.run_channels()
+        finally:
+            Waveform.sample_range = sample_range
+
+        assert sequence.channel_moved_ranges[mock_awg1] == [
+            (pytest.approx(1.9e-6), pytest.approx(2e-6), pytest.approx(-0.3e-6))]
+        # The pulse is copied, only its edges and the range it left are sampled
+        assert sum(sampled) < 310
+
+        expected_waveform, expected_amp = Blank(1.6e-6).concat(Gaussian(0.1e-6, 1)) \
+            .concat(Blank(1.2e-6)).concat(DC(0.1e-6, 0.5)) \
+            .normalized_sample(mock_awg1.device.sample_rate)
+        assert expected_amp == mock_awg1.device.raw_waveform_amp
+        assert len(expected_waveform) == len(mock_awg1.device.raw_waveform)
+        assert np.allclose(mock_awg1.device.raw_waveform, expected_waveform)
+
+        # Moving the last slice changes the length of the channel, which is sampled again
+        slice2.start_from = 2.5e-6
+        sequence.setup_channels()
+        sequence.run_channels()
+        assert mock_awg1._changed_samples is None
+
+        expected_waveform, _ = Blank(1.6e-6).concat(Gaussian(0.1e-6, 1)) \
+            .concat(Blank(1.7e-6)).concat(DC(0.1e-6, 0.5)) \
+            .normalized_sample(mock_awg1.device.sample_rate)
+        assert len(expected_waveform) == len(mock_awg1.device.raw_waveform)
+        assert np.allclose(mock_awg1.device.raw_waveform, expected_waveform)
+
+    def test_fixed_slice_shift_segment_bounds(self):
+        runtime = init_runtime()
+        sequence, slice0, slice1, slice2 = init_fixed_sequence(runtime)
+
+        # Segments start and end between samples, which round differently once moved
+        slice1.add_waveform(mock_awg2, DC(3 * 1e-9, 1).concat(Blank(72 * 1e-9))
+                            .concat(DC(43 * 1e-9, -0.3)))
+        slice2.add_waveform(mock_awg2, DC(0.1e-6, 0.5))
+
+        sequence.setup_trigger()
+        sequence.setup_channels()
+        sequence.run_channels()
+
+        for start_from in range(100, 900, 37):
+            slice1.start_from = start_from * 1e-9
+            sequence.setup_channels()
+            sequence.run_channels()
+
+            expected_waveform, _ = mock_awg2.waveform.normalized_sample(
+                mock_awg2.device.sample_rate)
+            assert (mock_awg2.device.raw_waveform == expected_waveform).all()
+
+    def test_incremental_resample(self):
+        runtime = init_runtime()
+        sequence, slice0, slice1, slice2 = init_fixed_sequence(runtime)
+
+        slice1.add_waveform(mock_awg0, DC(0.1e-6, 2))
+        slice2.add_waveform(mock_awg0, DC(0.1e-6, 3))
+        slice2.add_waveform(mock_awg3, DC(0.1e-6, 1))
+
+        sequence.setup_trigger()
+        sequence.setup_channels()
+        sequence.run_channels()
+        samples = mock_awg0._samples
+        upload_count = mock_awg0.device.upload_count
+        range_upload_count = mock_awg0.device.range_upload_count
+        range_upload_size = mock_awg0.device.range_upload_size
+
+        slice1.clear_waveform(mock_awg0)
+        slice1.add_waveform(mock_awg0, DC(0.1e-6, -1))
+        sequence.setup_channels()
+
+        assert sequence.channel_update_list == [mock_awg0]
+        # Blank padding of the slice doesn't count as changed
+        start, end = sequence.channel_changed_ranges[mock_awg0]
+        assert abs(start - 1.9e-6) < 1e-15 and abs(end - 2e-6) < 1e-15
+
+        sequence.run_channels()
+
+        expected_waveform, expected_amp = Blank(1.9e-6).concat(DC(0.1e-6, -1)) \
+            .concat(Blank(0.9e-6)).concat(DC(0.1e-6, 3)) \
+            .normalized_sample(mock_awg0.device.sample_rate)
+
+        assert mock_awg0._samples is samples
+        # Only the changed part is written
+        assert mock_awg0.device.upload_count == upload_count
+        assert mock_awg0.device.range_upload_count == range_upload_count + 1
+        assert mock_awg0.device.range_upload_size - range_upload_size < 1100
+        assert expected_amp == mock_awg0.device.raw_waveform_amp
+        assert len(expected_waveform) == len(mock_awg0.device.raw_waveform)
+        assert (mock_awg0.device.raw_waveform == expected_waveform).all()
+
+    def test_incremental_resample_keeps_later_bounds(self):
+        runtime = init_runtime()
+        sequence, channel = init_fresh_sequence(runtime)
+        slice0 = FixedSlice("slice_0", 0, 200e-9)
+        slice1 = FixedSlice("slice_1", 442e-9, 100e-9)
+        slice2 = FixedSlice("slice_2", 1.2e-6, 100e-9)
+        for slice in (slice0, slice1, slice2):
+            sequence.add_slice(slice)
+        slice2.set_waveform_padding(channel, PaddingPosition.PADDING_BEHIND)
+
+        slice0.add_waveform(channel, DC(35.137e-9, 1).concat(DC(73.457e-9, 1)))
+        slice1.add_waveform(channel, DC(69e-9, 2))
+        slice2.add_waveform(channel, DC(10.5e-9, 3))
+        sequence.setup()
+        sequence.run_channels()
+
+        # Summing up the widths in slice_0 rounds differently, which must not move slice_1
+        slice0.clear_waveform(channel)
+        slice0.add_waveform(channel, DC(71.309e-9, 1).concat(DC(7.463e-9, 1)))
+        sequence.setup_channels()
+        sequence.run_channels()
+
+        expected_waveform, expected_amp = \
+            channel.waveform.normalized_sample(channel.device.sample_rate)
+        assert channel._changed_samples is not None
+        assert expected_amp == channel.device.raw_waveform_amp
+        assert (channel.device.raw_waveform == expected_waveform).all()
+
+    def test_dac_channel_buffers(self):
+        runtime = init_runtime()
+        sequence, channel = init_fresh_sequence(runtime, dac_dtype=np.int16)
+        slice0 = FixedSlice("slice_0", 0, 1e-6)
+        sequence.add_slice(slice0)
+        default_sample_cache.clear()
+
+        slice0.add_waveform(channel, DC(0.1e-6, 1).concat(Gaussian(0.2e-6, -2)))
+        sequence.setup()
+        sequence.run_channels()
+        samples, dac_buffer = channel._samples, channel._dac_buffer
+
+        # Changed range only, then everything
+        slice0.clear_waveform(channel)
+        slice0.add_waveform(channel, DC(0.1e-6, 1).concat(Gaussian(0.2e-6, 3)))
+        sequence.setup_channels()
+        sequence.run_channels()
+        assert channel._changed_samples is not None
+        channel.set_waveform(Blank(0.7e-6).concat(DC(0.1e-6, -4)).concat(Gaussian(0.2e-6, 3)))
+        channel.run()
+
+        # Real samples and DAC data are written into the same buffers each time, and
+        # nothing goes through the sample cache
+        assert channel._samples is samples and channel._dac_buffer is dac_buffer
+        assert default_sample_cache.stats()["entries"] == 0
+
+        expected_waveform, expected_amp = Blank(0.7e-6).concat(DC(0.1e-6, -4)) \
+            .concat(Gaussian(0.2e-6, 3)).normalized_sample(channel.device.sample_rate)
+        assert channel.device.raw_waveform.dtype == np.int16
+        assert channel.device.raw_waveform_amp == expected_amp
+        assert np.array_equal(channel.device.raw_waveform,
+                              np.rint(expected_waveform * 32767).astype(np.int16))
+
+    def test_amplitude_only_change(self):
+        runtime = init_runtime()
+        sequence, slice0, slice1, slice2 = init_fixed_sequence(runtime)
+
+        slice1.add_waveform(mock_awg1, DC(0.1e-6, 0.5).concat(Gaussian(0.2e-6, 1)))
+
+        sequence.setup_trigger()
+        sequence.setup_channels()
+        sequence.run_channels()
+        upload_count = mock_awg1.device.upload_count
+        raw_waveform = mock_awg1.device.raw_waveform
+
+        slice1.clear_waveform(mock_awg1)
+        slice1.add_waveform(mock_awg1, (DC(0.1e-6, 0.5).concat(Gaussian(0.2e-6, 1))) * 3)
+        sequence.setup_channels()
+        sequence.run_channels()
+
+        expected_waveform, expected_amp = Blank(1e-6).concat(Blank(0.7e-6)).concat(DC(0.1e-6, 1.5)) \
+            .concat(Gaussian(0.2e-6, 3)) \
+            .normalized_sample(mock_awg1.device.sample_rate)
+
+        assert mock_awg1.device.upload_count == upload_count
+        assert mock_awg1.device.raw_waveform is raw_waveform
+        assert abs(mock_awg1.device.amplitude - expected_amp) < 1e-12
+        assert np.allclose(mock_awg1.device.raw_waveform, expected_waveform)
+
+    def test_same_data_not_uploaded(self):
+        runtime = init_runtime()
+        sequence, slice0, slice1, slice2 = init_fixed_sequence(runtime)
+
+        slice1.add_waveform(mock_awg1, DC(0.1e-6, 0.5).concat(DC(0.2e-6, 1)))
+
+        sequence.setup_trigger()
+        sequence.setup_channels()
+        sequence.run_channels()
+        upload_count = mock_awg1.device.upload_count
+
+        # Same samples from a different waveform, the channel keeps running untouched
+        slice1.clear_waveform(mock_awg1)
+        slice1.add_waveform(mock_awg1, SumWave(DC(0.3e-6, 0.5), Blank(0.1e-6).concat(DC(0.2e-6, 0.5))))
+        mock_awg1.device.running = "untouched"
+        sequence.setup_channels()
+        assert mock_awg1 not in sequence.channel_update_list
+        sequence.run_channels()
+
+        assert mock_awg1.device.upload_count == upload_count
+        assert mock_awg1.device.running == "untouched"
+
+    def test_concurrent_channels(self):
+        runtime = init_runtime()
+        runtime.config.channel_workers = 4
+        sequence, slice0, slice1, slice2 = init_fixed_sequence(runtime)
+
+        waveforms = {mock_awg0: DC(0.1e-6, 1), mock_awg3: DC(0.2e-6, 2), mock_awg6: DC(0.3e-6, 3)}
+        for channel, waveform in waveforms.items():
+            slice2.add_waveform(channel, waveform)
+
+        sequence.setup_trigger()
+        sequence.setup_channels()
+        for channel in waveforms:
+            assert not channel.device.running
+        sequence.run_channels()
+
+        for channel, waveform in waveforms.items():
+            expected_waveform, _ = waveform.normalized_sample(channel.device.sample_rate)
+            assert channel.device.running
+            assert (channel.device.raw_waveform[-len(expected_waveform):] == expected_waveform).all()
+
+        def fail(channel):
+            raise RuntimeError(channel.name)
+
+        with pytest.raises(RuntimeError):
+            sequence.for_each_channel(fail, list(waveforms))
+        assert sequence.for_each_channel(lambda channel: channel.name, list(waveforms)) == \
+            [channel.name for channel in waveforms]
+
+    def test_close_channel_workers(self):
+        runtime = init_runtime()
+        runtime.config.channel_workers = 4
+        sequence, slice0, slice1, slice2 = init_fixed_sequence(runtime)
+        slice2.add_waveform(mock_awg0, DC(0.1e-6, 1))
+        slice2.add_waveform(mock_awg3, DC(0.2e-6, 2))
+        sequence.setup_channels()
+        sequence.run_channels()
+
+        workers = list(sequence._channel_executor._threads)
+        assert workers
+        sequence.close()
+        assert not any(thread.is_alive() for thread in workers)
+
+        # Started again when needed, and closed along with the sequence it belongs to
+        sequence.stop_channels()
+        workers = list(sequence._channel_executor._threads)
+        runtime.create_sequence(mock_dg, 50000)
+        assert not any(thread.is_alive() for thread in workers)
+
+    def test_double_buffered_channel(self):
+        runtime = init_runtime()
+        sequence, slice0, channel = init_double_buffered_sequence(runtime)
+
+        slice0.add_waveform(channel, DC(0.1e-6, 1))
+        sequence.setup_trigger()
+        sequence.setup_channels()
+        sequence.run_channels()
+        first_waveform = channel.device.raw_waveform
+        first_slot = channel.device.active_slot
+
+        # The next waveform goes into the idle slot while the channel keeps playing
+        slice0.clear_waveform(channel)
+        slice0.add_waveform(channel, DC(0.1e-6, 1).concat(DC(0.1e-6, -1)))
+        sequence.setup_channels()
+        sequence.upload_channels()
+        assert channel.device.running
+        assert channel.device.raw_waveform is first_waveform
+        assert channel.device.active_slot == first_slot
+
+        sequence.run_channels()
+        expected_waveform, _ = Blank(0.8e-6).concat(DC(0.1e-6, 1)).concat(DC(0.1e-6, -1)) \
+            .normalized_sample(channel.device.sample_rate)
+        assert channel.device.running
+        assert channel.device.active_slot == 1 - first_slot
+        assert (channel.device.raw_waveform == expected_waveform).all()
+
+        # Switching back only selects the other slot
+        upload_count = channel.device.upload_count
+        slice0.clear_waveform(channel)
+        slice0.add_waveform(channel, DC(0.1e-6, 1))
+        sequence.setup_channels()
+        sequence.run_channels()
+        assert channel.device.upload_count == upload_count
+        assert channel.device.active_slot == first_slot
+        assert (channel.device.raw_waveform == first_waveform).all()
+
     def test_flex_slice_stack(self):
         runtime = init_runtime()
         sequence, slice0, slice1, slice2 = init_flex_sequence(runtime)
@@ -182,6 +521,68 @@ class TestSequence:
 
         assert (mock_awg0.device.raw_waveform == expected_waveform).all()
 
+    def test_flex_slice_duration_cache(self):
+        outer = FlexSlice("outer")
+        middle = FlexSlice("middle")
+        inner0 = FlexSlice("inner0")
+        inner1 = FlexSlice("inner1")
+        outer.add_sub_slice(middle)
+        middle.add_sub_slice(inner0)
+        middle.add_sub_slice(inner1)
+        inner0.add_waveform(mock_awg0, DC(0.1e-6, 1))
+        inner1.add_waveform(mock_awg0, DC(0.2e-6, 1))
+
+        assert outer.duration == pytest.approx(0.3e-6)
+
+        # Cached values are used as long as nothing changes below
+        inner1.waveforms[mock_awg0] = DC(1e-6, 1)
+        assert outer.duration == pytest.approx(0.3e-6)
+
+        inner1.clear_waveform(mock_awg0)
+        inner1.add_waveform(mock_awg0, DC(0.5e-6, 1))
+        assert outer.duration == pytest.approx(0.6e-6)
+        assert inner0.duration == pytest.approx(0.1e-6)
+
+        inner2 = FlexSlice("inner2")
+        inner2.add_waveform(mock_awg1, DC(0.4e-6, 1))
+        middle.add_sub_slice(inner2)
+        assert outer.duration == pytest.approx(1e-6)
+
+    def test_flex_slice_stretch(self):
+        runtime = init_runtime()
+        sequence, slice0, slice1, slice2 = init_flex_sequence(runtime)
+
+        # Drive pulse, a delay, then readout: only the delay changes
+        delay = FlexSlice("delay")
+        readout = FlexSlice("readout")
+        slice1.add_sub_slice(delay)
+        slice1.add_sub_slice(readout)
+        slice0.add_waveform(mock_awg1, DC(0.1e-6, 1))
+        delay.add_waveform(mock_awg1, Blank(0.2e-6))
+        readout.add_waveform(mock_awg0, DC(0.1e-6, 2))
+
+        sequence.setup_trigger()
+        sequence.setup_channels()
+        sequence.run_channels()
+        drive_upload_count = mock_awg1.device.upload_count
+
+        delay.clear_waveform(mock_awg1)
+        delay.add_waveform(mock_awg1, Blank(0.5e-6))
+        sequence.setup_channels()
+
+        # The drive channel is only blank where it changed
+        assert sequence.channel_update_list == [mock_awg0]
+        start, end = sequence.channel_changed_ranges[mock_awg0]
+        assert abs(start - 0.3e-6) < 1e-15 and abs(end - 0.7e-6) < 1e-15
+
+        sequence.run_channels()
+
+        assert mock_awg1.device.upload_count == drive_upload_count
+        expected_waveform, _ = Blank(0.6e-6).concat(DC(0.1e-6, 2)) \
+            .normalized_sample(mock_awg0.device.sample_rate)
+        assert len(expected_waveform) == len(mock_awg0.device.raw_waveform)
+        assert (mock_awg0.device.raw_waveform == expected_waveform).all()
+
     def test_sub_slice_single_channel(self):
         runtime = init_runtime()
         sequence = init_nake_sequence(runtime)
@@ -316,6 +717,106 @@ class TestSequence:
         assert mock_awg1 in updated
         assert mock_awg2 in updated
 
+    def test_clear_absent_waveform(self):
+        runtime = init_runtime()
+        sequence, slice0, slice1, slice2 = init_fixed_sequence(runtime)
+
+        slice1.add_waveform(mock_awg0, DC(0.1e-6, 2))
+
+        sequence.setup_trigger()
+        sequence.setup_channels()
+        sequence.run_channels()
+
+        # Neither slice2 nor any slice ever had a waveform for mock_awg1
+        slice2.clear_waveform(mock_awg0)
+        slice2.clear_waveform(mock_awg1)
+        sequence.setup_channels()
+        assert sequence.channel_update_list == []
+
+        # The same channel cleared twice in a row
+        slice1.clear_waveform(mock_awg0)
+        sequence.setup_channels()
+        slice1.clear_waveform(mock_awg0)
+        sequence.setup_channels()
+        assert sequence.channel_update_list == []
+
+    def test_compile_visits_changed_slices_only(self):
+        runtime = init_runtime()
+        sequence, slice0, slice1, slice2 = init_fixed_sequence(runtime)
+
+        slice0.add_waveform(mock_awg1, DC(0.1e-6, 1))
+        slice1.add_waveform(mock_awg0, DC(0.1e-6, 2))
+        slice2.add_waveform(mock_awg0, DC(0.1e-6, 3))
+
+        sequence.setup_trigger()
+        sequence.setup_channels()
+        sequence.run_channels()
+
+        visited = []
+
+        def record_visits(slice):
+            get_waveform = slice.get_waveform
+
+            def _get_waveform(channel):
+                visited.append((slice, channel))
+                return get_waveform(channel)
+            slice.get_waveform = _get_waveform
+
+        for _slice in (slice0, slice1, slice2):
+            record_visits(_slice)
+
+        slice1.clear_waveform(mock_awg0)
+        slice1.add_waveform(mock_awg0, DC(0.1e-6, -2))
+        sequence.setup_channels()
+        sequence.run_channels()
+
+        assert visited == [(slice1, mock_awg0)]
+        assert sequence.channel_update_list == [mock_awg0]
+
+        expected_waveform, _ = Blank(1.9e-6).concat(DC(0.1e-6, -2)).concat(Blank(0.9e-6)) \
+            .concat(DC(0.1e-6, 3)).normalized_sample(mock_awg0.device.sample_rate)
+        assert len(expected_waveform) == len(mock_awg0.device.raw_waveform)
+        assert (mock_awg0.device.raw_waveform == expected_waveform).all()
+
+    def test_versions(self):
+        runtime = init_runtime()
+        sequence, slice0, slice1, slice2 = init_fixed_sequence(runtime)
+
+        sub_slice0 = FlexSlice("sub_slice0")
+        sub_slice1 = FlexSlice("sub_slice1")
+        slice1.add_sub_slice(sub_slice0)
+        slice1.add_sub_slice(sub_slice1)
+        sub_slice0.add_waveform(mock_awg0, DC(0.1e-6, 1))
+        sub_slice1.add_waveform(mock_awg0, DC(0.1e-6, 2))
+
+        sequence.setup_trigger()
+        sequence.setup_channels()
+        sequence.run_channels()
+        compiled_version = sequence.compiled_version
+        channel_version = mock_awg0.version
+
+        assert slice1.version < compiled_version
+        assert slice1.version == max(sub_slice0.version, sub_slice1.version)
+
+        sub_slice1.clear_waveform(mock_awg0)
+        sub_slice1.add_waveform(mock_awg0, DC(0.1e-6, 3))
+
+        assert sub_slice0.version < compiled_version < sub_slice1.version
+        assert slice1.version == sub_slice1.version
+        assert slice2.version < compiled_version
+
+        sequence.setup_channels()
+        sequence.run_channels()
+
+        assert sequence.compiled_version > slice1.version
+        assert mock_awg0.version > channel_version
+
+        # Nothing changed, the channel is not touched
+        channel_version = mock_awg0.version
+        sequence.setup_channels()
+        assert sequence.channel_update_list == []
+        assert mock_awg0.version == channel_version
+
     def test_waveform_overlap_exception(self):
         runtime = init_runtime()
         sequence, slice0, slice1, slice2 = init_fixed_sequence(runtime)
@@ -358,6 +859,56 @@ class TestSequence:
         assert expected_amp == mock_awg10.device.raw_waveform_amp
         assert (mock_awg10.device.raw_waveform == expected_waveform).all()
 
+    def test_waveform_gate_update(self):
+        runtime = init_runtime()
+        sequence, slice0, channel, gate = init_fresh_gate_sequence(runtime)
+
+        waveform = DC(20e-9, 1)
+        slice0.add_waveform(channel, waveform)
+
+        sequence.setup_trigger()
+        sequence.setup_channels()
+        sequence.run_channels()
+
+        # The gate only starts in the middle, but the channel changes everywhere
+        for gate_waveform in [Blank(5e-9).concat(DC(15e-9, 1)),
+                              Blank(10e-9).concat(DC(10e-9, 1))]:
+            slice0.clear_waveform(gate)
+            slice0.add_waveform(gate, gate_waveform)
+            sequence.setup_channels()
+            sequence.run_channels()
+
+            expected_waveform, _ = (gate_waveform * waveform) \
+                .normalized_sample(channel.device.sample_rate)
+            assert len(expected_waveform) == len(channel.device.raw_waveform)
+            assert (channel.device.raw_waveform == expected_waveform).all()
+
+    def test_gated_channel_incremental_resample(self):
+        runtime = init_runtime()
+        sequence, slice0, channel, gate = init_fresh_gate_sequence(runtime)
+        sequence.setup_trigger()
+
+        # Each step changes the gated channel, the gate, or both
+        steps = [
+            (DC(20e-9, 1), None),
+            (None, Blank(5e-9).concat(DC(15e-9, 1))),
+            (DC(10e-9, 0.5).concat(DC(10e-9, 1)), None),
+            (None, DC(10e-9, 1).concat(Blank(10e-9))),
+            (DC(20e-9, -1), Blank(2e-9).concat(DC(16e-9, 1))),
+        ]
+        for waveform, gate_waveform in steps:
+            for target, target_waveform in [(channel, waveform), (gate, gate_waveform)]:
+                if target_waveform is not None:
+                    slice0.clear_waveform(target)
+                    slice0.add_waveform(target, target_waveform)
+            sequence.setup_channels()
+            sequence.run_channels()
+
+            expected_waveform, _ = channel.get_gated_waveform() \
+                .normalized_sample(channel.device.sample_rate)
+            assert len(expected_waveform) == len(channel.device.raw_waveform)
+            assert (channel.device.raw_waveform == expected_waveform).all()
+
     def test_waveform_before_trigger_exception(self):
         runtime = init_runtime()
         sequence = init_fixed_sequence(runtime)
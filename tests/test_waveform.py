@@ -0,0 +1,468 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+from thunderq.waveforms.native.waveform import (Waveform, SumWave, CarryWave, Sequence,
+                                                Sin, Cos, ComplexExp, DC, Blank,
+                                                Gaussian, CalibratedIQ, Real, Imag)
+from thunderq.waveforms.native.sample_cache import SampleCache, default_sample_cache
+from thunderq.waveforms.native.optimizer import simplify
+from thunderq.waveforms.native import dac
+from thunderq.waveforms.native.analysis import (runs, sample_runs, constant_value, amplitude_ratio,
+                                               content_range, differing_range, segment_bounds)
+from thunderq.helper.iq_calibration_container import IQCalibrationContainer
+
+
+def make_calibrated_iq():
+    IQ_cali = IQCalibrationContainer(I_amp_factor=0.9, Q_amp_factor=1.1,
+                                     I_phase_shift=0.1, Q_phase_shift=-0.2,
+                                     I_time_offset=1e-9, Q_time_offset=2e-9)
+    return CalibratedIQ(50e6,
+                        I_waveform=Gaussian(40e-9, 0.5),
+                        Q_waveform=DC(40e-9, 0.3),
+                        IQ_cali=IQ_cali)
+
+
+def make_test_waveforms():
+    return [
+        Sin(50e-9, 0.5, 2 * np.pi * 100e6, 0.3),
+        Cos(50e-9, 0.5, 2 * np.pi * 100e6, 0.3),
+        ComplexExp(50e-9, 0.5, 2 * np.pi * 100e6, 0.3),
+        DC(50e-9, 0.7),
+        DC(50e-9, 0.7, complex_phi=0.5),
+        Blank(50e-9),
+        Gaussian(50e-9, 0.8),
+        SumWave(Gaussian(50e-9, 0.8), Sin(30e-9, 0.2, 2 * np.pi * 100e6)),
+        CarryWave(Gaussian(50e-9, 0.8), Cos(30e-9, 0.2, 2 * np.pi * 100e6)),
+        Blank(10e-9).concat(Gaussian(20e-9, 1)).concat(DC(10e-9, 0.3)),
+        make_calibrated_iq(),
+        Real(make_calibrated_iq()),
+        Imag(make_calibrated_iq()),
+    ]
+
+
+class TestWaveform:
+    class ScalarOnlyWave(Waveform):
+        def at(self, time):
+            return self.amplitude * time if 0 <= time < self.width else 0
+
+    def test_at_array_matches_at(self):
+        times = np.arange(-10e-9, 70e-9, 0.5e-9)
+        for waveform in make_test_waveforms():
+            expected = np.array([waveform.at(t) for t in times])
+            assert np.allclose(waveform.at_array(times), expected), str(waveform)
+
+    def test_at_array_fallback(self):
+        waveform = self.ScalarOnlyWave(10e-9, 2)
+        times = np.arange(-1e-9, 12e-9, 1e-9)
+        assert np.allclose(waveform.at_array(times),
+                           [waveform.at(t) for t in times])
+
+    def test_direct_sample_padding(self):
+        waveform = Blank(5e-9).concat(DC(10e-9, 1))
+        data = waveform.direct_sample(1e9, min_unit=16)
+
+        assert isinstance(data, np.ndarray)
+        assert len(data) == 16
+        assert (data[:5] == 0).all()
+        assert (data[5:15] == 1).all()
+        assert (data[15:] == 0).all()
+
+    def test_normalized_sample(self):
+        waveform = DC(5e-9, -2).concat(DC(5e-9, 1))
+        data, max_abs = waveform.normalized_sample(1e9, min_unit=4)
+
+        assert max_abs == 2
+        assert len(data) == 12
+        assert np.allclose(data, [-1] * 5 + [0.5] * 5 + [0, 0])
+
+    def test_sample_into_dac_buffer(self):
+        waveform = DC(5e-9, -2).concat(Gaussian(10e-9, 1))
+        data, max_abs = waveform.normalized_sample(1e9, min_unit=16)
+        assert waveform.sample_length(1e9, min_unit=16) == len(data) == 16
+
+        int_buffer = np.full(20, 99, dtype=np.int16)
+        assert waveform.sample_into(int_buffer, 1e9, min_unit=16) == max_abs
+        assert np.array_equal(int_buffer[:16], np.rint(data * 32767).astype(np.int16))
+        assert (int_buffer[16:] == 99).all()
+
+        float_buffer = np.empty(16, dtype=np.float32)
+        assert waveform.sample_into(float_buffer, 1e9, min_unit=16) == max_abs
+        assert np.allclose(float_buffer, data)
+
+    def test_quantize_in_blocks(self):
+        data = np.sin(np.arange(3 * dac.QUANTIZE_BLOCK_SIZE + 5) * 1e-3) * 2
+        buffer = np.empty(len(data), dtype=np.int16)
+
+        assert dac.quantize(data, buffer) == np.abs(data).max()
+        assert np.array_equal(buffer, np.rint(data / np.abs(data).max() * 32767))
+        # Only a block is converted at once
+        assert len(dac._thread_buffers.work) <= dac.QUANTIZE_BLOCK_SIZE
+
+    def test_sample_blocks(self):
+        waveform = Blank(20e-9).concat(Gaussian(30e-9, -3)).concat(DC(10e-9, 1)) \
+            .concat(Real(make_calibrated_iq()))
+        data, max_abs = waveform.normalized_sample(1e9, min_unit=16)
+
+        sampler = waveform.sample_blocks(1e9, block_size=32, min_unit=16)
+        blocks = list(sampler)
+        assert sampler.max_abs == max_abs
+        assert len(blocks) == len(sampler) and all(len(block) <= 32 for block in blocks)
+        assert np.allclose(np.concatenate(blocks), data)
+
+        blocks = list(waveform.sample_blocks(1e9, block_size=7, min_unit=16, dtype=np.int16))
+        assert np.array_equal(np.concatenate(blocks), np.rint(data * 32767).astype(np.int16))
+
+    def test_sample_blocks_memory(self):
+        # 1e7 samples would take 80 MB as float64 at once
+        waveform = Blank(5e-3).concat(Gaussian(100e-9, 1)).concat(DC(5e-3, 0.5))
+        tracemalloc.start()
+        try:
+            sampler = waveform.sample_blocks(1e9, block_size=65536)
+            for _ in zip(range(3), sampler):
+                pass
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        assert peak < 10 * 1024 ** 2
+
+    def test_thumbnail_sample_narrow_waveform(self):
+        waveform = Blank(5e-6).concat(DC(1e-9, 1)).concat(Blank(5e-6))
+        data = waveform.thumbnail_sample(np.arange(0, 10e-6, 1e-6))
+
+        assert data.max() == 1
+
+    def test_sequence_segment_lookup(self):
+        waveform = DC(2e-9, 1).concat(Blank(0)).concat(DC(3e-9, 2)) \
+            .concat(Sin(5e-9, 1, 2 * np.pi * 100e6))
+        times = np.array([4e-9, -1e-9, 0, 2e-9, 9e-9, 1e-9, 10e-9, 5e-9])
+
+        assert waveform.at(2e-9) == 2
+        assert np.allclose(waveform.at_array(times),
+                           [waveform.at(t) for t in times])
+
+    def test_sequence_dc_subclass(self):
+        class Ramp(DC):
+            def at(self, time):
+                return time * 1e9 if 0 <= time < self.width else 0
+
+            def at_array(self, times):
+                times = np.asarray(times)
+                return np.where((times >= 0) & (times < self.width), times * 1e9, 0)
+
+        waveform = DC(2e-9, 1).concat(Ramp(4e-9, 1))
+        times = np.arange(0, 6e-9, 0.5e-9)
+
+        assert np.allclose(waveform.at_array(times), [waveform.at(t) for t in times])
+
+    def test_sequence_concat_is_persistent(self):
+        base = DC(1e-9, 1).concat(DC(1e-9, 2))
+        extended1 = base.concat(DC(1e-9, 3))
+        extended2 = base.concat(DC(2e-9, 4))
+        extended3 = extended1.concat(base)
+
+        assert len(base.sequence) == 2 and base.width == 2e-9
+        assert [w.amplitude for w in extended1.sequence] == [1, 2, 3]
+        assert [w.amplitude for w in extended2.sequence] == [1, 2, 4]
+        assert [w.amplitude for w in extended3.sequence] == [1, 2, 3, 1, 2]
+        assert extended2.each_waveform_start_at == [0, 1e-9, 2e-9, 4e-9]
+        assert extended2.at(3.5e-9) == 4
+        assert extended1.at(3.5e-9) == 0
+
+    def test_sequence_append_to(self):
+        waveform = Blank(2e-9).append_to(DC(1e-9, 1).concat(DC(1e-9, 2)))
+        assert [w.amplitude for w in waveform.sequence] == [1, 2, 0]
+        assert waveform.width == 4e-9
+
+    def test_calibrated_iq_pair(self):
+        default_sample_cache.clear()
+        waveform = make_calibrated_iq()
+        times = np.arange(0, waveform.width, 1e-9)
+
+        I_data, Q_data = waveform.sample_pair(1e9)
+        assert len(I_data) == len(Q_data) == len(times) + waveform._padding_length(len(times), 16)
+        assert np.allclose(I_data[:len(times)], Real(waveform).at_array(times))
+        assert np.allclose(Q_data[:len(times)], Imag(waveform).at_array(times))
+
+        # Both channels share the pair sampled above
+        assert Real(make_calibrated_iq()).direct_sample(1e9) is I_data
+        assert Imag(make_calibrated_iq()).direct_sample(1e9) is Q_data
+        data, max_abs = Imag(waveform).normalized_sample(1e9, min_unit=16)
+        assert np.allclose(data * max_abs, Q_data)
+
+    def test_sequence_samples_iq_parts_from_pair(self):
+        default_sample_cache.clear()
+        waveform = make_calibrated_iq()
+        I_data, Q_data = waveform.sample_pair(1e9, min_unit=1)
+
+        for part, data in ((Real, I_data), (Imag, Q_data)):
+            sequence = Blank(3e-9).concat(part(waveform)).concat(DC(2e-9, 1))
+            samples = sequence.direct_sample(1e9, min_unit=1)
+            assert np.array_equal(samples[3:3 + len(data)], data)
+            assert np.array_equal(sequence.sample_range(1e9, 10, 30), samples[10:30])
+
+            # Off the sample grid, the part is evaluated
+            shifted = Blank(3.5e-9).concat(part(waveform))
+            times = np.arange(0, shifted.width, 1e-9)
+            assert np.allclose(shifted.direct_sample(1e9, min_unit=1), shifted.at_array(times))
+
+    def test_structural_key(self):
+        assert Sin(1e-9, 1, 2, 3).structural_key() == Sin(1e-9, 1, 2, 3).structural_key()
+        assert Sin(1e-9, 1, 2, 3).structural_key() != Cos(1e-9, 1, 2, 3).structural_key()
+        assert DC(1e-9, 1).concat(Blank(1e-9)).structural_key() == \
+            DC(1e-9, 1).concat(Blank(1e-9)).structural_key()
+        assert self.ScalarOnlyWave(1e-9, 1).structural_key() is None
+        assert SumWave(DC(1e-9, 1), self.ScalarOnlyWave(1e-9, 1)).structural_key() is None
+
+    def test_sample_cache_hit(self):
+        default_sample_cache.clear()
+        data1, amp1 = Gaussian(100e-9, 0.5).normalized_sample(1e9)
+        data2, amp2 = Gaussian(100e-9, 0.5).normalized_sample(1e9)
+
+        assert data1 is data2 and amp1 == amp2
+        assert not data1.flags.writeable
+        assert default_sample_cache.stats()["hits"] == 1
+        assert default_sample_cache.stats()["misses"] == 1
+
+        Gaussian(100e-9, 0.6).normalized_sample(1e9)
+        Gaussian(100e-9, 0.5).normalized_sample(2e9)
+        assert default_sample_cache.stats()["misses"] == 3
+
+    def test_uncached_sample(self):
+        default_sample_cache.clear()
+        waveform = Blank(100e-9).concat(Gaussian(100e-9, 0.5))
+        data, amp = waveform.normalized_sample(1e9, cached=False)
+
+        assert data.flags.writeable
+        assert waveform.direct_sample(1e9, cached=False) is not \
+            waveform.direct_sample(1e9, cached=False)
+        assert default_sample_cache.stats()["entries"] == 0
+        assert np.array_equal(data, waveform.normalized_sample(1e9)[0])
+
+    def test_structural_key_is_kept(self):
+        waveform = Blank(100e-9).concat(Gaussian(100e-9, 0.5))
+        key = waveform.structural_key()
+
+        assert waveform.structural_key() is key
+        assert (waveform * 2).structural_key() is not key
+
+
+class TestSampleCache:
+    def test_lru_eviction(self):
+        cache = SampleCache(max_bytes=3 * 80)
+        for i in range(3):
+            cache.put(i, np.zeros(10))
+        cache.get(0)
+        cache.put(3, np.zeros(10))
+
+        assert len(cache) == 3
+        assert cache.get(1) is None
+        assert cache.get(0) is not None
+        assert cache.current_bytes == 3 * 80
+
+    def test_oversized_entry(self):
+        cache = SampleCache(max_bytes=40)
+        cache.put("big", (np.zeros(10), 1.0))
+
+        assert cache.get("big") is None
+        assert cache.current_bytes == 0
+
+
+class TestWaveformValueSemantics:
+    def test_operators_do_not_modify_operands(self):
+        waveform = Gaussian(10e-9, 0.5)
+        doubled = waveform * 2
+        negated = -waveform
+        absolute = abs(negated)
+
+        assert waveform.amplitude == 0.5
+        assert doubled.amplitude == 1
+        assert negated.amplitude == -0.5
+        assert absolute.amplitude == 0.5
+
+    def test_composite_operators_do_not_modify_children(self):
+        wave1 = DC(10e-9, 1)
+        wave2 = Sin(10e-9, 2, 1e8)
+
+        sum_wave = SumWave(wave1, wave2) * 3
+        carry_wave = CarryWave(wave1, wave2) * 3
+        sequence = wave1.concat(wave2) * 3
+
+        assert wave1.amplitude == 1 and wave2.amplitude == 2
+        assert sum_wave.wave1.amplitude == 3 and sum_wave.wave2.amplitude == 6
+        assert carry_wave.wave1.amplitude == 3 and carry_wave.wave2.amplitude == 2
+        assert [w.amplitude for w in sequence.sequence] == [3, 6]
+
+    def test_equality_and_hash(self):
+        assert DC(1e-9, 1) == DC(1e-9, 1)
+        assert DC(1e-9, 1) != DC(1e-9, 2)
+        assert DC(1e-9, 1) != Blank(1e-9)
+        assert hash(DC(1e-9, 1).concat(Gaussian(1e-9))) == \
+            hash(DC(1e-9, 1).concat(Gaussian(1e-9)))
+        assert len({Gaussian(1e-9), Gaussian(1e-9), Gaussian(2e-9)}) == 2
+
+        opaque = TestWaveform.ScalarOnlyWave(1e-9, 1)
+        assert opaque == opaque
+        assert opaque != TestWaveform.ScalarOnlyWave(1e-9, 1)
+
+    def test_waveforms_are_frozen(self):
+        waveform = Gaussian(10e-9, 0.5)
+        key = waveform.structural_key()
+        for attr, value in (("amplitude", 1), ("width", 20e-9)):
+            with pytest.raises(AttributeError):
+                setattr(waveform, attr, value)
+        with pytest.raises(AttributeError):
+            make_calibrated_iq().scale_I = 2
+        with pytest.raises(AttributeError):
+            DC(1e-9, 1).concat(Blank(1e-9))._segments = []
+
+        assert waveform.amplitude == 0.5 and waveform.structural_key() == key
+        assert (waveform * 2).structural_key() != key
+
+    def test_sequence_key_includes_offsets(self):
+        sequence = Sequence.from_segments([DC(1e-9, 1), DC(1e-9, 2)], [0, 1e-9, 2e-9])
+        shifted = Sequence.from_segments([DC(1e-9, 1), DC(1e-9, 2)],
+                                         [0, np.nextafter(1e-9, 1), 2e-9])
+
+        assert sequence == DC(1e-9, 1).concat(DC(1e-9, 2))
+        assert sequence != shifted
+        assert sequence.structural_key() != shifted.structural_key()
+        assert (shifted * 2).each_waveform_start_at == shifted.each_waveform_start_at
+
+
+class TestWaveformCompiler:
+    def test_program_matches_at_array(self):
+        times = np.arange(-10e-9, 70e-9, 0.25e-9)
+        nested = Blank(5e-9).concat(
+            CarryWave(DC(20e-9, 0.5).concat(Blank(5e-9)),
+                      SumWave(Gaussian(30e-9, 1), Cos(10e-9, 0.3, 2 * np.pi * 200e6)))
+        ).concat(Real(ComplexExp(10e-9, 1, 1e8))).concat(Imag(DC(5e-9, 1)))
+        gated = CarryWave(Blank(2e-9).concat(DC(10e-9, 1)), make_calibrated_iq())
+
+        for waveform in make_test_waveforms() + [nested, gated,
+                                                  TestWaveform.ScalarOnlyWave(20e-9, 1e7)]:
+            program = waveform.compile()
+            assert np.allclose(program.evaluate(times), waveform.at_array(times)), str(waveform)
+
+    def test_evaluate_into_buffer(self):
+        waveform = Blank(5e-9).concat(Real(make_calibrated_iq()))
+        times = np.arange(0, waveform.width, 1e-9)
+        out = np.full(len(times) + 3, 7.0)
+
+        waveform.compile().evaluate(times, out=out[:len(times)])
+
+        assert np.allclose(out[:len(times)], waveform.at_array(times))
+        assert (out[len(times):] == 7).all()
+
+    def test_evaluate_unsorted_times(self):
+        waveform = DC(5e-9, 1).concat(Gaussian(10e-9, 2))
+        times = np.array([12e-9, 1e-9, 20e-9, 7e-9, -1e-9])
+        assert np.allclose(waveform.compile().evaluate(times), waveform.at_array(times))
+
+
+class TestWaveformOptimizer:
+    def test_simplified_samples_match(self):
+        times = np.arange(-10e-9, 70e-9, 0.25e-9)
+        nested = Blank(5e-9).concat(Blank(0)).concat(
+            Blank(2e-9).concat(DC(3e-9, 0.5)).concat(DC(2e-9, 0.5))
+        ).concat(CarryWave(DC(20e-9, 0.5), Gaussian(15e-9, 1))).concat(Blank(3e-9))
+        gated = CarryWave(Blank(2e-9).concat(DC(10e-9, 1)), make_calibrated_iq())
+        folded = SumWave(Blank(30e-9), CarryWave(Gaussian(10e-9, 1), DC(10e-9, 2j)))
+
+        for waveform in make_test_waveforms() + [nested, gated, folded]:
+            simplified = simplify(waveform)
+            assert simplified.width == waveform.width, str(waveform)
+            assert np.allclose(simplified.at_array(times), waveform.at_array(times)), str(waveform)
+
+    def test_sequence_is_flattened_and_merged(self):
+        waveform = Blank(5e-9).concat(Blank(0)).concat(
+            Blank(2e-9).concat(DC(3e-9, 0.5)).concat(DC(2e-9, 0.5))
+        ).concat(Blank(3e-9)).concat(Blank(1e-9))
+        simplified = simplify(waveform)
+
+        assert [type(w) for w in simplified.sequence] == [Blank, DC, Blank]
+        assert np.allclose(simplified.each_waveform_start_at, [0, 7e-9, 12e-9, 16e-9])
+        assert len(simplified.direct_sample(1e9)) == len(waveform.direct_sample(1e9))
+
+    def test_constant_factor_is_folded(self):
+        gaussian = Gaussian(10e-9, 1)
+        assert simplify(CarryWave(DC(10e-9, 0.5), gaussian)) == Gaussian(10e-9, 0.5)
+        assert simplify(CarryWave(gaussian, DC(10e-9, 1))) is gaussian
+        assert simplify(CarryWave(Blank(10e-9), gaussian)) == Blank(10e-9)
+
+        padded = simplify(CarryWave(DC(20e-9, 2), gaussian))
+        assert [type(w) for w in padded.sequence] == [Gaussian, Blank]
+        assert padded.width == 20e-9
+
+        # The DC doesn't cover the whole waveform, nothing to fold
+        assert type(simplify(CarryWave(DC(5e-9, 2), gaussian))) is CarryWave
+
+
+class TestWaveformRuns:
+    def test_runs(self):
+        gate = Blank(5e-9).concat(DC(10e-9, 1)).concat(Blank(5e-9))
+        waveform = CarryWave(gate, Gaussian(20e-9, 1)).concat(DC(5e-9, 0.5)).concat(DC(5e-9, 0.5))
+
+        waveform_runs = runs(waveform)
+        assert [value for _, _, value in waveform_runs] == [0, None, 0, 0.5]
+        assert np.allclose([end for _, end, _ in waveform_runs], [5e-9, 15e-9, 20e-9, 30e-9])
+        assert sample_runs(waveform, 1e9) == [(0, 5, 0), (5, 15, None), (15, 20, 0), (20, 30, 0.5)]
+
+    def test_constant_value(self):
+        assert constant_value(DC(5e-9, 2)) == 2
+        assert constant_value(Sin(5e-9, 2, 0, np.pi / 2)) == 2
+        assert constant_value(SumWave(DC(5e-9, 1), DC(5e-9, 2))) == 3
+        assert constant_value(DC(5e-9, 2).concat(DC(5e-9, 2))) == 2
+        assert constant_value(SumWave(DC(5e-9, 1), DC(4e-9, 2))) is None
+        assert constant_value(CarryWave(Blank(5e-9), make_calibrated_iq())) == 0
+        assert constant_value(SumWave(Blank(5e-9), make_calibrated_iq())) is None
+        assert constant_value(Gaussian(5e-9, 1)) is None
+
+    def test_content_range(self):
+        waveform = Blank(5e-9).concat(DC(10e-9, 1)).concat(Blank(5e-9))
+        assert np.allclose(content_range(waveform), (5e-9, 15e-9))
+        assert content_range(Blank(5e-9)) == (0, 0)
+
+    def test_differing_range(self):
+        pulse = Blank(5e-9).concat(DC(10e-9, 1))
+        assert differing_range(pulse, pulse) == (0, 0)
+        # Only the padding grows
+        assert differing_range(pulse.concat(Blank(10e-9)), pulse.concat(Blank(5e-9))) == (0, 0)
+        start, end = differing_range(pulse.concat(Blank(5e-9)).concat(DC(5e-9, 2)),
+                                     pulse.concat(Blank(10e-9)).concat(DC(5e-9, 2)))
+        assert np.allclose((start, end), (15e-9, 30e-9))
+
+    def test_segment_bounds(self):
+        waveform = Blank(5e-9).concat(SumWave(DC(10e-9, 1), Gaussian(5e-9, 1))).concat(DC(5e-9, 1))
+        assert np.allclose(segment_bounds(waveform), [0, 5e-9, 10e-9, 15e-9, 20e-9])
+
+    def test_amplitude_ratio(self):
+        waveform = Blank(5e-9).concat(SumWave(Gaussian(10e-9, 0.5), Sin(10e-9, 1, 1e8))) \
+            .concat(CarryWave(DC(10e-9, 1), Cos(10e-9, 0.5, 1e8)))
+
+        assert amplitude_ratio(waveform, waveform) == 1
+        assert abs(amplitude_ratio(waveform * 3, waveform) - 3) < 1e-12
+        assert amplitude_ratio(Gaussian(10e-9, 2), Gaussian(10e-9, 0.5)) == 4
+        assert amplitude_ratio(CarryWave(DC(5e-9, 2), Gaussian(10e-9, 3)),
+                               CarryWave(DC(5e-9, 1), Gaussian(10e-9, 1))) == 6
+        assert amplitude_ratio(Blank(5e-9).concat(DC(1e-9, 2)), Blank(5e-9).concat(DC(1e-9, 1))) == 2
+        assert amplitude_ratio(DC(5e-9, 2).concat(DC(1e-9, 2)), DC(5e-9, 1).concat(DC(1e-9, 2))) is None
+        assert amplitude_ratio(Gaussian(10e-9, 2), Gaussian(11e-9, 1)) is None
+        assert amplitude_ratio(ComplexExp(10e-9, 2), ComplexExp(10e-9, 1)) is None
+
+    def test_constant_regions_are_not_evaluated(self):
+        class CountingWave(TestWaveform.ScalarOnlyWave):
+            evaluated = 0
+
+            def at_array(self, times):
+                CountingWave.evaluated += len(times)
+                return super().at_array(times)
+
+        gate = Blank(50e-9).concat(DC(10e-9, 1)).concat(Blank(40e-9))
+        waveform = CarryWave(gate, CountingWave(100e-9, 1e7))
+        times = np.arange(0, 100e-9, 1e-9)
+
+        assert np.allclose(waveform.compile().evaluate(times), waveform.at_array(times))
+        CountingWave.evaluated = 0
+        waveform.compile().evaluate(times)
+        assert CountingWave.evaluated == 10
@@ -8,6 +8,8 @@ from thunderq.helper.mock_devices import (mock_awg0, mock_awg1, mock_awg2,
                                           mock_awg12, mock_awg10_gate,
                                           mock_awg11_gate, mock_awg12_gate,
                                           mock_dg)
+from thunderq.helper.mock_devices import MockAWG
+from thunderq.sequencer import AWGChannel, WaveformGate
 from thunderq.sequencer.slices import FlexSlice, FixedSlice
 
 
@@ -78,3 +80,56 @@ def init_gate_sequence(runtime: Runtime):
         .link_waveform_channel("awg_0_12_gate", mock_awg12_gate)
 
     return sequence
+
+
+def init_double_buffered_sequence(runtime: Runtime):
+    sequence = runtime.create_sequence(mock_dg, 50000)
+    channel = AWGChannel("double_buffered_awg", MockAWG("double_buffered_awg"),
+                         double_buffered=True)
+    sequence.add_trigger("test_trigger_0", 0, 0, 2e-6) \
+        .link_waveform_channel("double_buffered_awg", channel)
+
+    slice0 = FixedSlice("slice_0", 0, 1e-6)
+    sequence.add_slice(slice0)
+
+    return sequence, slice0, channel
+
+
+def init_fresh_gate_sequence(runtime: Runtime):
+    # Gated channel on its own devices, unlike the shared mock channels
+    sequence = runtime.create_sequence(mock_dg, 50000)
+    gate = WaveformGate("fresh_gate")
+    channel = AWGChannel("fresh_gated_awg", MockAWG("fresh_gated_awg"), gate)
+    sequence.add_trigger("test_trigger_0", 0, 0, 2e-6) \
+        .link_waveform_channel("fresh_gated_awg", channel) \
+        .link_waveform_channel("fresh_gate", gate)
+
+    slice0 = FixedSlice("slice_0", 0, 20e-9)
+    sequence.add_slice(slice0)
+
+    return sequence, slice0, channel, gate
+
+
+def init_fresh_sequence(runtime: Runtime, **channel_args):
+    # A channel on its own device, without slices
+    sequence = runtime.create_sequence(mock_dg, 50000)
+    channel = AWGChannel("fresh_awg", MockAWG("fresh_awg"), **channel_args)
+    sequence.add_trigger("test_trigger_0", 0, 0, 2e-6) \
+        .link_waveform_channel("fresh_awg", channel)
+
+    return sequence, channel
+
+
+def init_iq_sequence(runtime: Runtime):
+    # I and Q channels on their own devices
+    sequence = runtime.create_sequence(mock_dg, 50000)
+    channel_I = AWGChannel("awg_I", MockAWG("awg_I"))
+    channel_Q = AWGChannel("awg_Q", MockAWG("awg_Q"))
+    sequence.add_trigger("test_trigger_0", 0, 0, 2e-6) \
+        .link_waveform_channel("awg_I", channel_I) \
+        .link_waveform_channel("awg_Q", channel_Q)
+
+    slice0 = FixedSlice("slice_0", 0, 1e-6)
+    sequence.add_slice(slice0)
+
+    return sequence, slice0, channel_I, channel_Q
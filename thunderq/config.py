@@ -11,3 +11,7 @@ class Config:
         self.logging_level = "INFO"
         self.show_sequence = True
         self.log_output_type = Config.LogOutputType.THUNDERBOARD
+        self.sample_cache_size = 256 * 1024 ** 2  # in bytes
+        # Number of threads that stop, upload and run AWG channels at once, 1 for one
+        # channel after another
+        self.channel_workers = 1
@@ -1,3 +1,5 @@
+import asyncio
+
 from thunderq.procedures.native import Procedure
 
 
@@ -11,16 +13,29 @@ class Cycle:
         self.sequence_initialized = False
         self.trigger_initialized = False
 
-    def run_sequence(self):
+    def setup_trigger(self):
         if not self.trigger_initialized:
             self.sequence.setup_trigger()
             self.trigger_initialized = True
+
+    def run_sequence(self):
+        self.setup_trigger()
         self.sequence.setup_channels()
         self.sequence.run_channels()
 
+    async def run_sequence_async(self):
+        if not self.trigger_initialized:
+            await self.sequence.setup_trigger_async()
+            self.trigger_initialized = True
+        await self.sequence.setup_channels_async()
+        await self.sequence.run_channels_async()
+
     def stop_sequence(self):
         self.sequence.stop_channels()
 
+    async def stop_sequence_async(self):
+        await self.sequence.stop_channels_async()
+
     def add_procedure(self, procedure: Procedure):
         self.procedures.append(procedure)
 
@@ -34,6 +49,39 @@ class Cycle:
 
         self.run_sequence()
 
+        return self.collect()
+
+    # run() split in steps, for sweeps that overlap cycles: prepare() generates and samples
+    # the waveforms, upload() sends them to the devices, arm() starts the sequence, collect()
+    # fetches the results.
+    def prepare(self, upload=True):
+        for procedure in self.procedures:
+            assert isinstance(procedure, Procedure)
+            procedure.pre_run()
+
+        self.setup_trigger()
+        self.sequence.prepare_channels()
+
+        if upload:
+            self.upload()
+
+    def generate(self):
+        # Only generate the waveforms and hand them to the channels
+        for procedure in self.procedures:
+            assert isinstance(procedure, Procedure)
+            procedure.pre_run()
+
+        self.sequence.assign_waveforms()
+
+    def upload(self):
+        self.sequence.stop_updated_channels()
+        self.sequence.upload_channels()
+        self.sequence.send_sequence_plot(self.sequence.sequence_plot_sample_rate)
+
+    def arm(self):
+        self.sequence.run_channels()
+
+    def collect(self):
         results = {}
 
         for procedure in self.procedures:
@@ -42,3 +90,20 @@ class Cycle:
                 results.update(ret)
 
         return results
+
+    async def run_async(self):
+        for procedure in self.procedures:
+            assert isinstance(procedure, Procedure)
+            procedure.pre_run()
+
+        await self.run_sequence_async()
+
+        results = {}
+
+        # post_run() may wait for acquisition devices, keep the event loop free meanwhile
+        for procedure in self.procedures:
+            ret = await asyncio.to_thread(procedure.post_run)
+            if ret:
+                results.update(ret)
+
+        return results
@@ -12,10 +12,14 @@ class Sweep1DExperiment(SweepExperiment):
     def __init__(self, runtime, name, cycle, *,
                  plot=True,
                  save_to_file=True,
-                 save_path='data'):
+                 save_path='data',
+                 pipelined=False,
+                 double_buffered=False,
+                 waveform_bank=False):
         super().__init__(runtime, name, cycle,
                          plot=plot, save_to_file=save_to_file,
-                         save_path=save_path)
+                         save_path=save_path, pipelined=pipelined,
+                         double_buffered=double_buffered, waveform_bank=waveform_bank)
 
         self.sweep_parameter = ""
         self.result_plot_senders = {}
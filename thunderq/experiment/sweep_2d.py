@@ -12,10 +12,14 @@ class Sweep2DExperiment(SweepExperiment):
     def __init__(self, runtime, name, cycle, *,
                  plot=True,
                  save_to_file=True,
-                 save_path='data'):
+                 save_path='data',
+                 pipelined=False,
+                 double_buffered=False,
+                 waveform_bank=False):
         super().__init__(runtime, name, cycle,
                          plot=plot, save_to_file=save_to_file,
-                         save_path=save_path)
+                         save_path=save_path, pipelined=pipelined,
+                         double_buffered=double_buffered, waveform_bank=waveform_bank)
 
         self.fast_scan_param = ''
         self.slow_scan_param = ''
@@ -75,7 +79,7 @@ class Sweep2DExperiment(SweepExperiment):
 
     def post_cycle(self, cycle_count, cycle_index, params_dict, results_dict):
         super().post_cycle(cycle_count, cycle_index, params_dict, results_dict)
-        self.swept_mask.itemset(cycle_index, 0)
+        self.swept_mask[cycle_index] = 0
         if not self.runtime.logger.disabled and self.plot:
             threading.Thread(target=self.make_realtime_plot_and_send,
                              args=(cycle_count,),
@@ -1,8 +1,13 @@
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import matplotlib as mpl
 
+from thunderq.sequencer import AWGChannel, WaveformGate
+from thunderq.waveforms.native import simplify
+
 mpl.rcParams['font.size'] = 9
 mpl.rcParams['lines.linewidth'] = 1.0
 
@@ -11,7 +16,18 @@ class SweepExperiment:
     def __init__(self, runtime, name, cycle, *,
                  plot=True,
                  save_to_file=True,
-                 save_path='data'):
+                 save_path='data',
+                 pipelined=False,
+                 double_buffered=False,
+                 waveform_bank=False):
+        # pipelined: generate and sample the waveforms of the next point on a worker thread
+        #     while the current one runs and is acquired. post_run() of the procedures must
+        #     not depend on the swept parameters, as they may be set to the next point already.
+        # double_buffered: like pipelined, and also upload the next point meanwhile. All AWG
+        #     channels of the sequence have to be double buffered.
+        # waveform_bank: for sweeps whose points differ in waveforms only. pre_run() of all
+        #     points is called before the sweep starts, their waveforms are sampled and written
+        #     into the slots of the AWGs at once, and each point only selects its slot.
         self.runtime = runtime
         self.name = name
         self.cycle = cycle
@@ -32,32 +48,127 @@ class SweepExperiment:
         self.file_cols = []
         self.file = None
 
+        self.pipelined = pipelined or double_buffered
+        self.double_buffered = double_buffered
+        self.waveform_bank = waveform_bank
+
     def run(self):
         self.time_start_at = time.time()
 
         self.pre_sweep()
 
         self.total_points = np.prod(self.sweep_shape)
-        i = 0
-        current_point = {k: 0 for k in self.sweep_points.keys()}
-        for idx in np.ndindex(*self.sweep_shape):
-            self.pre_cycle(i, idx, current_point)
-            self.update_parameter(current_point)
-
-            results = self.cycle.run()
-            current_point, results = self.filter_result(current_point, results)
-
-            for key in results.keys():
-                if key in self.results.keys():
-                    self.results[key].itemset(idx, results[key])
+        if self.waveform_bank:
+            self.run_with_waveform_bank()
+        elif self.pipelined:
+            self.run_pipelined()
+        else:
+            i = 0
+            current_point = {k: 0 for k in self.sweep_points.keys()}
+            for idx in np.ndindex(*self.sweep_shape):
+                self.pre_cycle(i, idx, current_point)
+                self.update_parameter(current_point)
 
-            self.post_cycle(i, idx, current_point, results)
-            i += 1
+                results = self.cycle.run()
+                self.record_results(i, idx, current_point, results)
+                i += 1
 
         self.cycle.stop_sequence()
         self.post_sweep()
         return self.results
 
+    def run_pipelined(self):
+        if self.double_buffered:
+            not_double_buffered = [name for name, channel in self.cycle.sequence.channels.items()
+                                   if not channel.double_buffered
+                                   and not isinstance(channel, WaveformGate)]
+            assert not not_double_buffered, \
+                f"Channels {', '.join(not_double_buffered)} are not double buffered."
+
+        indices = list(np.ndindex(*self.sweep_shape))
+        if not indices:
+            return
+
+        def prepare_point(i):
+            point = self.pre_cycle(i, indices[i], {k: 0 for k in self.sweep_points.keys()})
+            self.update_parameter(point)
+            self.cycle.prepare(upload=self.double_buffered)
+            return point
+
+        # Point i + 1 is prepared on a worker thread while point i runs and is acquired.
+        # Results are still recorded in order.
+        with ThreadPoolExecutor(1, thread_name_prefix="sweep_prepare") as executor:
+            current_point = prepare_point(0)
+            for i, idx in enumerate(indices):
+                if not self.double_buffered:
+                    self.cycle.upload()
+                self.cycle.arm()
+
+                next_point = executor.submit(prepare_point, i + 1) \
+                    if i + 1 < len(indices) else None
+                results = self.cycle.collect()
+                self.record_results(i, idx, current_point, results)
+
+                current_point = next_point.result() if next_point else None
+
+    def run_with_waveform_bank(self):
+        sequence = self.cycle.sequence
+        indices = list(np.ndindex(*self.sweep_shape))
+        if not indices:
+            return
+
+        # Waveforms of every point, on each channel
+        bank = {}
+        for i, idx in enumerate(indices):
+            point = {key: self.sweep_points[key].item(idx) for key in self.sweep_points.keys()}
+            self.update_parameter(point)
+            self.cycle.generate()
+
+            for channel_name, channel in sequence.channels.items():
+                if isinstance(channel, WaveformGate):
+                    continue
+                assert isinstance(channel, AWGChannel), \
+                    f"Channel {channel_name} doesn't support waveform banks."
+
+                waveform = channel.get_gated_waveform()
+                if i == 0 and waveform is not None:
+                    bank[channel] = []
+                assert (channel in bank) == (waveform is not None), \
+                    f"Channel {channel_name} doesn't have a waveform in every point."
+                if waveform is not None:
+                    bank[channel].append(simplify(waveform))
+
+        channels = list(bank.keys())
+        workers = self.runtime.config.channel_workers
+        sequence.for_each_channel(lambda channel: channel.load_bank(bank[channel], workers),
+                                  channels)
+        self.cycle.setup_trigger()
+
+        try:
+            for i, idx in enumerate(indices):
+                point = self.pre_cycle(i, idx, {k: 0 for k in self.sweep_points.keys()})
+
+                switched = sequence.for_each_channel(
+                    lambda channel: channel.select_bank_entry(i), channels)
+                sequence.for_each_channel(lambda channel: channel.run(),
+                                          [channel for channel, switch in zip(channels, switched)
+                                           if switch])
+
+                results = self.cycle.collect()
+                self.record_results(i, idx, point, results)
+        finally:
+            for channel in channels:
+                channel.clear_bank()
+
+    def record_results(self, cycle_count, cycle_index, params_dict, results):
+        params_dict, results = self.filter_result(params_dict, results)
+
+        for key in results.keys():
+            if key in self.results.keys():
+                self.results[key][cycle_index] = results[key]
+
+        self.post_cycle(cycle_count, cycle_index, params_dict, results)
+
     def update_parameter(self, points):
         for param, val in points.items():
             self.sweep_parameter_setters[param](val)
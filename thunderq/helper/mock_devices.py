@@ -1,5 +1,7 @@
 import random
 
+import numpy as np
+
 from thunderq.sequencer import DGTrigger, AWGChannel, WaveformGate
 from thunderq.runtime import Logger
 from device_repo import DeviceType, AWG, DG, Digitizer
@@ -14,6 +16,14 @@ class MockAWG:
 
         self.raw_waveform = None
         self.raw_waveform_amp = 0
+        self.upload_count = 0
+        self.range_upload_count = 0
+        self.range_upload_size = 0
+
+        # Waveform slots, raw_waveform is the one selected for playing. There are two, more
+        # are added when written to.
+        self.slots = [None, None]  # (raw_waveform, amplitude) in each slot
+        self.active_slot = 0
 
         self.running = False
 
@@ -26,6 +36,32 @@ class MockAWG:
     def write_raw_waveform(self, raw_waveform, amplitude):
         self.raw_waveform = raw_waveform
         self.raw_waveform_amp = amplitude
+        self.amplitude = amplitude
+        self.slots[self.active_slot] = (raw_waveform, amplitude)
+        self.upload_count += 1
+
+    def write_raw_waveform_range(self, offset, raw_waveform):
+        waveform = np.array(self.raw_waveform)
+        waveform[offset:offset + len(raw_waveform)] = raw_waveform
+        self.raw_waveform = waveform
+        self.slots[self.active_slot] = (waveform, self.raw_waveform_amp)
+        self.range_upload_count += 1
+        self.range_upload_size += len(raw_waveform)
+
+    def write_raw_waveform_to_slot(self, slot, raw_waveform, amplitude):
+        assert not (self.running and slot == self.active_slot), \
+            "Can't write into the slot that is playing."
+        if slot >= len(self.slots):
+            self.slots.extend([None] * (slot + 1 - len(self.slots)))
+        self.slots[slot] = (np.array(raw_waveform), amplitude)
+        self.upload_count += 1
+
+    def select_slot(self, slot):
+        assert not self.running, "Can't switch slots while running."
+        assert self.slots[slot] is not None, "Nothing written into this slot."
+        self.active_slot = slot
+        self.raw_waveform, self.raw_waveform_amp = self.slots[slot]
+        self.amplitude = self.raw_waveform_amp
 
     def set_offset(self, offset_voltage):
         self.offset = offset_voltage
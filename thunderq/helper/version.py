@@ -0,0 +1,20 @@
+# helper.version
+# -------------------------
+# Generation counter shared by slices, procedures and channels.
+# Note:
+# 1. Each change takes a new number from next_version(). Numbers only grow and are never
+#     reused, so "changed since N" is just version > N, and a parent that takes the number of
+#     its changed child holds the max version below it.
+# 2. Versions are compared, never subtracted: nothing can be told from the gap between two.
+#
+
+import itertools
+import threading
+
+_counter = itertools.count(1)
+_lock = threading.Lock()
+
+
+def next_version():
+    with _lock:
+        return next(_counter)
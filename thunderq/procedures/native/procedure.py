@@ -1,30 +1,55 @@
+from thunderq.helper.version import next_version
+
+
 class Procedure:
     # Describe the change of waveforms during a time-span.
     # But it can also be used to do other task unrelated to waveforms.
 
     # Monitor the changes in these attributes, if modified, set self.has_update to True.
     # Useful for sequence helper to determine if it need to recompile the waveforms
+    # Each change also bumps self.version (see helper.version), and the version of the
+    # parameter in self.parameter_versions. has_update is True while self.version is newer
+    # than the one handled_version was set to, by setting has_update to False.
     _parameters = []
     _parameter_alias = {}
     _result_keys = []
 
     def __init__(self, name, result_prefix=""):
         self.name = name
-        self.has_update = True
+        self.handled_version = 0
+        self.version = next_version()
+        self.parameter_versions = {}
         self.result_prefix = result_prefix
         self.modified_params = []
 
+    @property
+    def has_update(self):
+        return self.version > self.handled_version
+
+    @has_update.setter
+    def has_update(self, value):
+        if value:
+            self.version = next_version()
+        else:
+            self.handled_version = self.version
+
     def __setattr__(self, key, value):
         if key in self._parameter_alias:
             param = self._parameter_alias[key]
         else:
             param = key
         if param in self._parameters:
-            super().__setattr__("has_update", True)
+            version = next_version()
+            super().__setattr__("version", version)
+            self.parameter_versions[param] = version
             if param not in self.modified_params:
                 self.modified_params.append(param)
         super().__setattr__(param, value)
 
+    def params_changed_since(self, version):
+        return [param for param, param_version in self.parameter_versions.items()
+                if param_version > version]
+
     def pre_run(self):
         # Generate the waveforms here
         raise NotImplementedError
@@ -3,6 +3,7 @@ import threading
 from thunderq.config import Config
 from thunderq.sequencer.sequence import Sequence
 from thunderq.helper.logger import Logger, ExperimentStatus
+from thunderq.waveforms.native import default_sample_cache
 
 
 class AttrDict(dict):
@@ -32,6 +33,8 @@ class Runtime:
                                  disabled=True)
             self.exp_status = ExperimentStatus(False, False)
 
+        default_sample_cache.resize(config.sample_cache_size)
+
         self.env = AttrDict()
         self._sequence = None
 
@@ -51,6 +54,8 @@ class Runtime:
             raise TypeError("Sequence not initialized. Please invoke create_sequence first.")
 
     def create_sequence(self, trigger_dev, cycle_freq):
+        if self._sequence:
+            self._sequence.close()
         self._sequence = Sequence(trigger_dev, cycle_freq, self)
         return self._sequence
 
@@ -1,4 +1,22 @@
-from thunderq.waveforms.native import Waveform
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from thunderq.waveforms.native import Waveform, simplify, content_range, segment_bounds
+from thunderq.waveforms.native.dac import quantize
+from thunderq.waveforms.native.analysis import amplitude_ratio
+from thunderq.helper.version import next_version
+
+# Time ranges are (start, end) tuples. None stands for the whole waveform.
+EMPTY_RANGE = (np.inf, -np.inf)
+
+
+def union_range(range1, range2):
+    if range1 is None or range2 is None:
+        return None
+    return min(range1[0], range2[0]), max(range1[1], range2[1])
 
 
 class WaveformChannel:
@@ -11,6 +29,15 @@ class WaveformChannel:
         else:
             self.gate_by = None
         self.waveform = None
+        # Time range in which the waveform changed since the channel last ran
+        self.changed_range = None
+        # Parts of the waveform that only moved since the channel last ran, see set_waveform()
+        self.moved_ranges = None
+        # If True, the channel keeps playing while the next waveform is uploaded, and
+        # doesn't need to be stopped before upload()
+        self.double_buffered = False
+        # Bumped on each change of the waveform, see helper.version
+        self.version = next_version()
 
     def get_gated_waveform(self) -> Waveform:
         if self.gate_by:
@@ -23,8 +50,33 @@ class WaveformChannel:
         else:
             return self.waveform
 
-    def set_waveform(self, waveform: Waveform):
+    def set_waveform(self, waveform: Waveform, changed_range=None, moved_ranges=None):
+        # changed_range: time range in which waveform differs from the previous one, both
+        #     being zero beyond their widths, None if unknown.
+        # moved_ranges: list of (start, end, shift), parts [start, end) of the previous
+        #     waveform found at [start + shift, end + shift) in waveform, or None. Only kept
+        #     if nothing else changed since the channel last ran.
+        unchanged = self.changed_range is not None and \
+            self.changed_range[0] >= self.changed_range[1]
         self.waveform = waveform
+        self.mark_changed(changed_range)
+        if unchanged:
+            self.moved_ranges = moved_ranges
+
+    def mark_changed(self, changed_range=None):
+        self.changed_range = union_range(self.changed_range, changed_range)
+        self.moved_ranges = None
+        self.version = next_version()
+
+    def prepare(self):
+        # Get the current waveform ready for run(). Returns False if the device already
+        # holds it, in which case the channel doesn't need to be stopped and run again.
+        return True
+
+    def upload(self):
+        # Send the prepared waveform to the device, without starting it. run() uploads it
+        # if this hasn't been done.
+        pass
 
     def run(self):
         raise NotImplementedError
@@ -38,6 +90,30 @@ class WaveformChannel:
     def get_offset(self):
         raise NotImplementedError
 
+    # Awaitable counterparts of the methods above. Device calls block, so they are run in
+    # a thread of the event loop's default executor.
+    async def set_waveform_async(self, waveform: Waveform, changed_range=None,
+                                 moved_ranges=None):
+        self.set_waveform(waveform, changed_range, moved_ranges)
+
+    async def prepare_async(self):
+        return await asyncio.to_thread(self.prepare)
+
+    async def upload_async(self):
+        await asyncio.to_thread(self.upload)
+
+    async def run_async(self):
+        await asyncio.to_thread(self.run)
+
+    async def stop_async(self):
+        await asyncio.to_thread(self.stop)
+
+    async def set_offset_async(self, offset):
+        await asyncio.to_thread(self.set_offset, offset)
+
+    async def get_offset_async(self):
+        return await asyncio.to_thread(self.get_offset)
+
 
 class WaveformGate(WaveformChannel):
     def __init__(self, name):
@@ -45,8 +121,46 @@ class WaveformGate(WaveformChannel):
         self.name = name
         self.base = None
 
+    def set_waveform(self, waveform: Waveform, changed_range=None, moved_ranges=None):
+        if (self.waveform is None) != (waveform is None):
+            # Gating starts or stops, the gated channel changes wherever it isn't zero
+            changed_range = None
+        super().set_waveform(waveform, changed_range, moved_ranges)
+
+    def mark_changed(self, changed_range=None):
+        super().mark_changed(changed_range)
+        if self.base:
+            self.base.mark_changed(self._gated_range(changed_range))
+
+    def _gated_range(self, changed_range):
+        # Time range in which the gated channel changes, as the gate changed in changed_range
+        if changed_range is None or changed_range[0] >= changed_range[1]:
+            return changed_range
+        if self.base.waveform is None:
+            return None
+        start, end = content_range(self.base.waveform)
+        if start >= end:
+            return changed_range
+        return union_range(changed_range, (start, end))
+
+    def prepare(self):
+        return False
+
     def run(self):
-        pass
+        self.changed_range = EMPTY_RANGE
+
+    # No device behind a gate, nothing to wait for
+    async def prepare_async(self):
+        return self.prepare()
+
+    async def upload_async(self):
+        self.upload()
+
+    async def run_async(self):
+        self.run()
+
+    async def stop_async(self):
+        self.stop()
 
     def stop(self):
         pass
@@ -62,24 +176,305 @@ class WaveformGate(WaveformChannel):
 class AWGChannel(WaveformChannel):
     from device_repo import AWG
 
-    def __init__(self, name, channel_dev: AWG, gate_by: WaveformGate = None):
+    def __init__(self, name, channel_dev: AWG, gate_by: WaveformGate = None, dac_dtype=None,
+                 double_buffered=False):
         # channel_dev: AWG channel from device_repo
+        # dac_dtype: if set (e.g. np.int16 or np.float32), samples are written into a
+        #     preallocated buffer of this type in DAC format, which is reused between runs.
+        #     Only use it with devices that accept such data and copy it when written.
+        # If channel_dev has write_raw_waveform_range(offset, raw_waveform), only the part
+        # of the data that changed is written when the amplitude stays the same.
+        # double_buffered: channel_dev has two waveform slots, written by
+        #     write_raw_waveform_to_slot(slot, raw_waveform, amplitude) and picked for playing
+        #     by select_slot(slot). The next waveform is written into the idle slot while the
+        #     other one plays, and the slots are swapped when the channel runs.
+        # The slots also hold the waveform bank, see load_bank().
 
         super().__init__(name, gate_by)
         self.name = name
         self.device = channel_dev
+        self.dac_dtype = dac_dtype
+        self.double_buffered = double_buffered
+        self._dac_buffer = None
+        self._samples = None  # Unnormalized (real) samples of the last run, reused as buffer
+        self._last_prepared = None  # (waveform, sample_rate, amplitude) of the last prepare()
+        self._prepared_data = None  # (normalized data, digest, amplitude) of the last sampling
+        self._uploaded = None  # (digest of data, amplitude) the device plays from the next run
+        self._changed_samples = None  # (first, last) samples changed by the last update, None for all
+        self._slots = {}  # slot: (digest of data, amplitude), if double buffered
+        self._active_slot = 0
+        self._swap_pending = False
+        self._bank = None  # Slot of each bank entry, while a bank is loaded
+        self._bank_entry_slot = None  # Slot selected by select_bank_entry()
+        self._prepared_version = None  # Channel version of the last prepare()
+        self._pending = None  # What run() has to send to the device
+        self._running = False  # Started by run(), and not stopped since
+
+    def _update_samples(self, waveform, sample_rate):
+        # Re-sample only the changed range if the samples of the last run are still usable
+        length = waveform.sample_length(sample_rate)
+        if self._samples is None or len(self._samples) != length or self.changed_range is None:
+            if self._samples is None or len(self._samples) != length:
+                self._samples = np.empty(length)
+            waveform.sample_range(sample_rate, 0, length, out=self._samples)
+            self._changed_samples = None
+        else:
+            moved_blocks = self._moved_blocks(waveform, sample_rate, length)
+            self._changed_samples = (0, 0)
+            start, end = self.changed_range
+            if start < end:
+                # One more sample on each side, in case of rounding
+                first = max(int(np.floor(start * sample_rate)) - 1, 0)
+                last = min(int(np.ceil(end * sample_rate)) + 1, length)
+                if first < last:
+                    self._sample_range(waveform, sample_rate, first, last, moved_blocks)
+                    self._changed_samples = (first, last)
+
+        self.changed_range = EMPTY_RANGE
+        self.moved_ranges = None
+        return self._samples
+
+    def _moved_blocks(self, waveform, sample_rate, length):
+        # [(first, samples)] of the last samples that moved by a whole number of samples, and
+        # belong at first now. Samples of a gated channel don't move with the waveform.
+        blocks = []
+        if self.moved_ranges is None or self.gate_by is not None:
+            return blocks
+
+        bound_samples = None
+        for start, end, shift in self.moved_ranges:
+            sample_shift = int(round(shift * sample_rate))
+            if abs(shift * sample_rate - sample_shift) > 1e-6:
+                # The block would have to be sampled on another grid
+                continue
+            # One sample off each edge, in case of rounding
+            first = max(int(np.ceil(start * sample_rate)) + 1, -sample_shift, 0)
+            last = min(int(np.ceil(end * sample_rate)) - 1, length - sample_shift)
+            if first >= last:
+                continue
+
+            if bound_samples is None:
+                bound_samples = np.array(segment_bounds(waveform)) * sample_rate
+            # Samples next to where a segment of the new waveform starts or ends may round
+            # differently than where they come from, leave them out to be sampled again
+            piece_first = first + sample_shift
+            block_last = last + sample_shift
+            near = bound_samples[(bound_samples > piece_first - 2) &
+                                 (bound_samples < block_last + 2)]
+            for bound in near:
+                cut_first, cut_last = int(np.floor(bound)) - 1, int(np.ceil(bound)) + 2
+                if cut_first > piece_first:
+                    piece_last = min(cut_first, block_last)
+                    blocks.append((piece_first, self._samples[piece_first - sample_shift:
+                                                              piece_last - sample_shift].copy()))
+                piece_first = max(piece_first, cut_last)
+            if piece_first < block_last:
+                blocks.append((piece_first, self._samples[piece_first - sample_shift:
+                                                          block_last - sample_shift].copy()))
+        return sorted(blocks, key=lambda block: block[0])
+
+    def _sample_range(self, waveform, sample_rate, first, last, moved_blocks):
+        # Sample first..last-1 again, but copy in the blocks that only moved
+        pointer = first
+        for block_first, block in moved_blocks:
+            block_last = min(block_first + len(block), last)
+            if block_first < pointer or block_last <= block_first:
+                continue
+            if pointer < block_first:
+                waveform.sample_range(sample_rate, pointer, block_first,
+                                      out=self._samples[pointer:block_first])
+            self._samples[block_first:block_last] = block[:block_last - block_first]
+            pointer = block_last
+        if pointer < last:
+            waveform.sample_range(sample_rate, pointer, last, out=self._samples[pointer:last])
+
+    def _rescaled_amplitude(self, waveform, sample_rate):
+        # If waveform is the last prepared one scaled by a positive factor, its normalized
+        # data is still valid, only the amplitude has to be changed.
+        if self._last_prepared is None or self._last_prepared[1] != sample_rate:
+            return None
+        last_waveform, _, last_amplitude = self._last_prepared
+
+        ratio = amplitude_ratio(waveform, last_waveform)
+        if ratio is None or np.imag(ratio) != 0 or np.real(ratio) <= 0 or last_amplitude == 0:
+            return None
+        ratio = np.real(ratio)
+
+        if ratio != 1:
+            self._samples *= ratio
+        self.changed_range = EMPTY_RANGE
+        self.moved_ranges = None
+        return last_amplitude * ratio
+
+    def _normalize(self, samples, reuse_buffer=True):
+        if self.dac_dtype is None:
+            amplitude = max(samples.max(), -samples.min()) if len(samples) else 0
+            wave_data = samples / amplitude if amplitude != 0 else samples.copy()
+        else:
+            if not reuse_buffer:
+                wave_data = np.empty(len(samples), dtype=self.dac_dtype)
+            else:
+                if self._dac_buffer is None or len(self._dac_buffer) != len(samples):
+                    self._dac_buffer = np.empty(len(samples), dtype=self.dac_dtype)
+                wave_data = self._dac_buffer
+            amplitude = quantize(samples, wave_data)
+
+        return wave_data, amplitude
+
+    @staticmethod
+    def _digest(wave_data):
+        digest = hashlib.blake2b(wave_data.dtype.str.encode())
+        digest.update(np.ascontiguousarray(wave_data).data)
+        return digest.digest()
+
+    def _supports_range_write(self):
+        return not self.double_buffered and hasattr(self.device, "write_raw_waveform_range")
+
+    def _changed_data_range(self, amplitude):
+        # (first, last) of the normalized data that differs from the data on the device,
+        # or None if it can't be told. Only valid right after _update_samples().
+        if self._changed_samples is None or self._uploaded is None or self._prepared_data is None:
+            return None
+        # Data of the last sampling has to be what the device holds, and normalized the
+        # same way
+        last_data, last_digest, last_amplitude = self._prepared_data
+        if last_digest != self._uploaded[0] or amplitude != last_amplitude \
+                or len(last_data) != len(self._samples):
+            return None
+        return self._changed_samples
+
+    def prepare(self):
+        waveform = simplify(self.get_gated_waveform())
+        sample_rate = self.device.get_sample_rate()
+
+        changed_data = None
+        amplitude = self._rescaled_amplitude(waveform, sample_rate)
+        if amplitude is None:
+            wave_data, amplitude = self._normalize(self._update_samples(waveform, sample_rate))
+            if self._supports_range_write():
+                changed_data = self._changed_data_range(amplitude)
+            self._prepared_data = (wave_data, self._digest(wave_data), amplitude)
+        wave_data, data_digest, _ = self._prepared_data
+
+        # Pending actions: (offset, data, amplitude, digest of the whole data), where data
+        # is None if only the amplitude changes, and offset is None for a full write.
+        if self._uploaded is None or data_digest != self._uploaded[0]:
+            if changed_data is not None and amplitude == self._uploaded[1]:
+                first, last = changed_data
+                self._pending = (first, wave_data[first:last], amplitude, data_digest)
+            else:
+                self._pending = (None, wave_data, amplitude, data_digest)
+        elif amplitude != self._uploaded[1]:
+            self._pending = (None, None, amplitude, data_digest)
+        else:
+            self._pending = None
+
+        self._last_prepared = (waveform, sample_rate, amplitude)
+        self._prepared_version = self.version
+        # A stopped channel has to run again, even if the device holds the data already
+        return self._pending is not None or not self._running
+
+    def upload(self):
+        if self._prepared_version != self.version:
+            self.prepare()
+
+        if self._pending is not None:
+            offset, wave_data, amplitude, data_digest = self._pending
+            if self.double_buffered:
+                self._upload_to_idle_slot(amplitude, data_digest)
+            elif wave_data is None:
+                self.device.set_amplitude(amplitude)
+            elif offset is not None:
+                self.device.write_raw_waveform_range(offset, wave_data)
+            else:
+                self.device.write_raw_waveform(wave_data, amplitude)
+            self._uploaded = (data_digest, amplitude)
+            self._pending = None
+
+    def _idle_slot(self):
+        # Slot 0 and 1 take turns. After a waveform bank, any other slot may be active.
+        return 1 if self._active_slot == 0 else 0
+
+    def _upload_to_idle_slot(self, amplitude, data_digest):
+        # _uploaded is what plays after the next run, which is the active slot if it
+        # holds the data already
+        if self._slots.get(self._active_slot) == (data_digest, amplitude):
+            self._swap_pending = False
+            return
+
+        idle_slot = self._idle_slot()
+        if self._slots.get(idle_slot) != (data_digest, amplitude):
+            self.device.write_raw_waveform_to_slot(idle_slot, self._prepared_data[0], amplitude)
+            self._slots[idle_slot] = (data_digest, amplitude)
+        self._swap_pending = True
 
     def run(self):
-        waveform = self.get_gated_waveform()
-        wave_data, amplitude = waveform.normalized_sample(
-            self.device.get_sample_rate())
+        self._running = True
+        if self._bank is not None:
+            self.device.run()
+            return
 
-        self.device.write_raw_waveform(wave_data, amplitude)
+        self.upload()
+        # The sample rate may change before the next run, check it again then
+        self._prepared_version = None
+
+        if self._swap_pending:
+            self.device.stop()
+            self._active_slot = self._idle_slot()
+            self.device.select_slot(self._active_slot)
+            self._swap_pending = False
 
         self.device.run()
 
     def stop(self):
         self.device.stop()
+        self._running = False
+
+    def load_bank(self, waveforms, workers=1):
+        # Sample waveforms on workers threads, and write them into the slots of channel_dev
+        # (see double_buffered), equal waveforms sharing one slot. Until clear_bank(),
+        # select_bank_entry(i) sets the channel to play waveforms[i], and run() only starts
+        # the device.
+        sample_rate = self.device.get_sample_rate()
+        unique_waveforms = list(dict.fromkeys(waveforms))
+
+        def sample(waveform):
+            samples = waveform.sample_range(sample_rate, 0, waveform.sample_length(sample_rate))
+            return self._normalize(samples, reuse_buffer=False)
+
+        with ThreadPoolExecutor(workers) as executor:
+            entries = list(executor.map(sample, unique_waveforms))
+
+        self.device.stop()
+        for slot, (wave_data, amplitude) in enumerate(entries):
+            self.device.write_raw_waveform_to_slot(slot, wave_data, amplitude)
+
+        slot_of = {waveform: slot for slot, waveform in enumerate(unique_waveforms)}
+        self._bank = [slot_of[waveform] for waveform in waveforms]
+        self._bank_entry_slot = None
+
+    def select_bank_entry(self, index):
+        # Returns True if the channel was stopped to switch, and has to run again
+        slot = self._bank[index]
+        if slot == self._bank_entry_slot:
+            return False
+        self.device.stop()
+        self.device.select_slot(slot)
+        self._active_slot = self._bank_entry_slot = slot
+        return True
+
+    def clear_bank(self):
+        # What the device holds is unknown to the channel from now on, the next run writes
+        # the whole waveform again
+        self._bank = None
+        self._bank_entry_slot = None
+        self._slots = {}
+        self._swap_pending = False
+        self._samples = None
+        self._last_prepared = None
+        self._prepared_data = None
+        self._uploaded = None
+        self._prepared_version = None
 
     def get_offset(self):
         return self.device.get_offset()
@@ -1,12 +1,17 @@
+import asyncio
 import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
 import numpy as np
 from matplotlib.figure import Figure
 import matplotlib as mpl
 
 from thunderq.sequencer.slices import Slice, FixedLengthSlice, FixedSlice, FlexSlice
-from thunderq.sequencer.channels import WaveformChannel, WaveformGate
+from thunderq.sequencer.channels import WaveformChannel, WaveformGate, EMPTY_RANGE, union_range
 from thunderq.sequencer.trigger import Trigger
-from thunderq.waveforms.native import Blank
+from thunderq.waveforms.native import Blank, content_range, differing_range
+from thunderq.waveforms.native import Sequence as WaveformSequence
+from thunderq.helper.version import next_version
 
 mpl.rcParams['font.size'] = 9
 mpl.rcParams['lines.linewidth'] = 1.0
@@ -38,11 +43,21 @@ class Sequence:
         self.channel_to_trigger = {}
         self.last_compiled_waveforms = {}
         self.channel_update_list = []
+        self.channel_changed_ranges = {}
+        self.channel_moved_ranges = {}
         self.runtime = runtime
 
         self.sequence_plot_sample_rate = 1e6
 
-        self._slice_length_history = {}
+        # See compile_waveforms() and place_waveforms()
+        self._placements = {}  # {channel: {slice: (start_from, waveform)}}
+        self._slice_placements = {}
+        self._slice_order = {}
+        self._assigned_waveforms = {}  # {channel: waveform last handed to it}
+        self._stopped_channels = {}  # {channel: None} stopped by stop_channels() since
+        self.compiled_version = 0  # Version (see helper.version) at the last compilation
+        self._channel_executor = None
+        self._channel_executor_workers = 0
 
     def add_trigger(self, name, trigger_channel, raise_at, drop_after=4e-6) -> TriggerSetup:
         self.trigger_setups[name] = TriggerSetup(name, trigger_channel, raise_at, drop_after, self)
@@ -61,8 +76,8 @@ class Sequence:
                 f"Out of range. Your slice ends at {slice.start_from + slice.duration}s, "
                 f"while each trigger cycle ends at {1/self.cycle_frequency}s.")
 
+        self._slice_order[slice] = len(self.slices)
         self.slices.append(slice)
-        self._slice_length_history[slice] = 0
 
         return self
 
@@ -70,6 +85,10 @@ class Sequence:
         self.setup_trigger()
         self.setup_channels()
 
+    async def setup_async(self):
+        await self.setup_trigger_async()
+        await self.setup_channels_async()
+
     def setup_trigger(self):
         self.trigger.set_cycle_frequency(self.cycle_frequency)
         for trigger in self.trigger_setups.values():
@@ -80,101 +99,315 @@ class Sequence:
                 trigger.drop_after
             )
 
+    async def setup_trigger_async(self):
+        await self.trigger.set_cycle_frequency_async(self.cycle_frequency)
+        await asyncio.gather(*(
+            self.trigger.set_channel_delay_async(trigger.trigger_channel, trigger.raise_at,
+                                                 trigger.drop_after)
+            for trigger in self.trigger_setups.values()
+        ))
+
     def compile_waveforms(self):
+        # Place the waveforms of the slices that changed on their channels, then compare the
+        # placements with the last compilation to find the channels that changed, and the time
+        # range in which they changed. Only (slice, channel) pairs that may have changed are
+        # visited. Returns the waveforms of all channels.
+        dirty = self.place_waveforms()
+
         self.channel_update_list = []
-        compiled_waveforms = self.last_compiled_waveforms
-        max_compiled_waveform_length = 0
+        self.channel_changed_ranges = {}
+        self.channel_moved_ranges = {}
+
+        for channel, slices in dirty.items():
+            channel_placements = self._placements.setdefault(channel, {})
+            trigger_start_from = self.channel_to_trigger[channel].raise_at
+
+            changed_range = EMPTY_RANGE
+            moved_ranges = []
+            added = False
+            placement_changed = False
+            for slice in slices:
+                start_from, slice_waveforms, _ = self._slice_placements[slice]
+                waveform = slice_waveforms.get(channel)
+                new = (start_from - trigger_start_from, waveform) if waveform is not None else None
+                old = channel_placements.get(slice)
+                if new is None and old is None:
+                    # e.g. cleared a channel the slice has no waveform for
+                    continue
+                if new is not None and old is not None and \
+                        new[0] == old[0] and (new[1] is old[1] or new[1] == old[1]):
+                    continue
 
-        for slice in self.slices:
-            channel_updated = slice.get_updated_channel()
-            if not channel_updated:
+                if new is None:
+                    channel_placements.pop(slice, None)
+                else:
+                    added = added or old is None
+                    channel_placements[slice] = new
+                placement_changed = True
+                start, end = self._changed_placement_range(old, new)
+                if start < end:
+                    changed_range = union_range(changed_range, (start, end))
+                if old is not None and new is not None and start < end and \
+                        (new[1] is old[1] or new[1] == old[1]):
+                    # Only moved, e.g. by changing start_from of a FixedSlice
+                    start, end = content_range(old[1])
+                    moved_ranges.append((old[0] + start, old[0] + end, new[0] - old[0]))
+
+            if added:
+                # Keep placements in the order of the slices
+                self._placements[channel] = channel_placements = dict(
+                    sorted(channel_placements.items(), key=lambda item: self._slice_order[item[0]]))
+
+            if not placement_changed and channel in self.last_compiled_waveforms:
                 continue
 
-            if abs(self._slice_length_history[slice] - slice.duration) > 1e-15:
-                channel_updated = self.channels.values()
-                self._slice_length_history[slice] = slice.duration
+            if channel_placements:
+                self.last_compiled_waveforms[channel] = \
+                    self._join_placements(self._channel_name(channel), channel_placements)
+            elif channel in self.last_compiled_waveforms:
+                self.last_compiled_waveforms[channel] = Blank(0)
+            else:
+                continue
 
+            if changed_range[0] >= changed_range[1] and \
+                    channel.waveform is not None and \
+                    self._assigned_waveforms.get(channel) is channel.waveform:
+                # Only blank parts grew, shrank or moved, what the channel got from this
+                # sequence still plays the same
+                continue
+
+            self.channel_update_list.append(channel)
+            self.channel_changed_ranges[channel] = changed_range
+            self.channel_moved_ranges[channel] = moved_ranges
+
+        return self.last_compiled_waveforms
+
+    def place_waveforms(self):
+        # Update the waveforms placed by the slices that changed, and return
+        # {channel: {slice: None}} of the placements that may have changed.
+        # self._slice_placements keeps {slice: (start_from, {channel: waveform}, end)}, where
+        # end is the end of the last waveform in the slice.
+        dirty = {}
+        max_compiled_waveform_length = 0
+        compiled_version, self.compiled_version = self.compiled_version, next_version()
+
+        for slice in self.slices:
             if isinstance(slice, FixedSlice):
                 start_from = slice.start_from
             else:
                 start_from = max_compiled_waveform_length
 
-            for channel_name, channel in self.channels.items():
-                if channel not in channel_updated:
-                    continue
-
-                if channel not in self.channel_update_list:
-                    self.channel_update_list.append(channel)
-                    if channel in self.last_compiled_waveforms:
-                        del self.last_compiled_waveforms[channel]
-
-                trigger_start_from = self.channel_to_trigger[channel].raise_at
-
-                assert trigger_start_from <= start_from, \
-                    f"Waveform assigned to channel before it is triggered! " \
-                    f"(Slice {slice.name}, Channel {channel_name})"
+            cached = self._slice_placements.get(slice)
+            if cached is not None and cached[0] == start_from and \
+                    slice.version <= compiled_version:
+                # Nothing changed in the slice or below since the last compilation
+                max_compiled_waveform_length = max(cached[2], max_compiled_waveform_length)
+                continue
 
-                waveform = slice.get_waveform(channel)
-                if not waveform:
-                    waveform = Blank(0)
+            if cached is not None and cached[0] == start_from:
+                slice_waveforms = cached[1]
+                channels = slice.get_updated_channel()
+            else:
+                # Moved or new, all waveforms of the slice have to be placed again
+                slice_waveforms = {}
+                channels = dict.fromkeys(slice.get_channels())
+                if cached is not None:
+                    channels.update(dict.fromkeys(cached[1]))
+
+            if cached is None or channels:
+                for channel in channels:
+                    if channel not in self.channel_to_trigger:
+                        continue
+                    dirty.setdefault(channel, {})[slice] = None
+
+                    waveform = slice.get_waveform(channel)
+                    if not waveform:
+                        slice_waveforms.pop(channel, None)
+                        continue
+
+                    assert self.channel_to_trigger[channel].raise_at <= start_from, \
+                        f"Waveform assigned to channel before it is triggered! " \
+                        f"(Slice {slice.name}, Channel {self._channel_name(channel)})"
+                    slice_waveforms[channel] = waveform
+
+                end = max([start_from + waveform.width for waveform in slice_waveforms.values()],
+                          default=0)
+                cached = self._slice_placements[slice] = (start_from, slice_waveforms, end)
+
+            max_compiled_waveform_length = max(cached[2], max_compiled_waveform_length)
 
-                max_compiled_waveform_length = max(
-                    start_from + waveform.width,
-                    max_compiled_waveform_length
-                )
+            slice.clear_channel_updated_flag()
 
-                if channel in compiled_waveforms:
-                    assert (compiled_waveforms[channel].width <=
-                            start_from - trigger_start_from), \
-                        f"Waveform overlap detected on channel {channel_name}."
+        return dirty
 
-                    if (compiled_waveforms[channel].width
-                            < start_from - trigger_start_from):
-                        padding_length = (start_from - trigger_start_from
-                                          - compiled_waveforms[channel].width)
-                        if padding_length > 1e-15:
-                            compiled_waveforms[channel] = \
-                                compiled_waveforms[channel].concat(
-                                    Blank(padding_length))
+    @staticmethod
+    def _changed_placement_range(old, new):
+        # Time range in which the channel changed, from the old and new (start_from, waveform)
+        # placement of a slice on it. Blank parts don't count, so a slice that moves or
+        # stretches only changes the channel where the waveforms it moves aren't blank.
+        if old is not None and new is not None and old[0] == new[0]:
+            start, end = differing_range(new[1], old[1])
+            return new[0] + start, new[0] + end
 
-                    compiled_waveforms[channel] = compiled_waveforms[channel].concat(waveform)
+        changed_range = EMPTY_RANGE
+        for placement in (old, new):
+            if placement is None:
+                continue
+            start, end = content_range(placement[1])
+            if start < end:
+                changed_range = union_range(changed_range,
+                                            (placement[0] + start, placement[0] + end))
+        return changed_range
+
+    def _channel_name(self, channel):
+        for channel_name, _channel in self.channels.items():
+            if _channel is channel:
+                return channel_name
+        return None
+
+    @staticmethod
+    def _join_placements(channel_name, channel_placements):
+        # Each placement starts exactly at its own offset, summing up the widths instead
+        # may round differently each time, and move the bounds of later placements.
+        segments = []
+        start_at = [0]
+        for start_from, waveform in channel_placements.values():
+            assert start_at[-1] <= start_from, \
+                f"Waveform overlap detected on channel {channel_name}."
+
+            if start_from - start_at[-1] > 1e-15:
+                segments.append(Blank(start_from - start_at[-1]))
+                start_at.append(start_from)
+            elif segments:
+                start_at[-1] = start_from
+
+            segments.append(waveform)
+            start_at.append(start_from + waveform.width)
+
+        if len(segments) == 1:
+            return segments[0]
+        return WaveformSequence.from_segments(segments, start_at)
+
+    def assign_waveforms(self):
+        # Hand the compiled waveforms to the channels that changed
+        compiled_waveform = self.compile_waveforms()
+        for channel in list(self.channel_update_list):
+            changed_range = self.channel_changed_ranges[channel]
+            moved_ranges = self.channel_moved_ranges[channel]
+            if self._assigned_waveforms.get(channel) is not channel.waveform:
+                # Changed by someone else meanwhile, the ranges tell nothing about it
+                changed_range, moved_ranges = None, None
+            channel.set_waveform(compiled_waveform[channel], changed_range, moved_ranges)
+            self._assigned_waveforms[channel] = compiled_waveform[channel]
+
+            # A gate changes the waveform of the channel it gates
+            if isinstance(channel, WaveformGate) and channel.base in compiled_waveform \
+                    and channel.base not in self.channel_update_list:
+                self.channel_update_list.append(channel.base)
+
+        # Stopped channels have to run again, even if their waveforms didn't change
+        for channel in self._stopped_channels:
+            if channel in compiled_waveform and channel not in self.channel_update_list:
+                self.channel_update_list.append(channel)
+        self._stopped_channels = {}
+
+    def prepare_channels(self):
+        # Compile and sample the waveforms of the changed channels, without stopping or
+        # writing to any of them
+        self.assign_waveforms()
+
+        # Channels whose device already holds the same data keep running untouched
+        need_update = self.for_each_channel(lambda channel: channel.prepare(),
+                                            self.channel_update_list)
+        self.channel_update_list = [channel for channel, need in
+                                    zip(self.channel_update_list, need_update) if need]
 
-                else:
-                    padding_length = start_from - trigger_start_from
-                    if padding_length > 1e-15:
-                        compiled_waveforms[channel] = \
-                            Blank(padding_length).concat(waveform)
-                    else:
-                        compiled_waveforms[channel] = waveform
+    def setup_channels(self):
+        self.prepare_channels()
+        self.stop_updated_channels()
 
-            slice.clear_channel_updated_flag()
+        self.send_sequence_plot(self.sequence_plot_sample_rate)
 
-        self.last_compiled_waveforms = compiled_waveforms
+    async def setup_channels_async(self):
+        self.assign_waveforms()
 
-        return compiled_waveforms
+        need_update = await asyncio.gather(*(channel.prepare_async()
+                                             for channel in self.channel_update_list))
+        self.channel_update_list = [channel for channel, need in
+                                    zip(self.channel_update_list, need_update) if need]
+        await asyncio.gather(*(channel.stop_async() for channel in self._channels_to_stop()))
 
-    def setup_channels(self):
-        compiled_waveform = self.compile_waveforms()
-        for channel, waveform in compiled_waveform.items():
-            if channel in self.channel_update_list:
-                channel.stop()
-                channel.set_waveform(waveform)
         self.send_sequence_plot(self.sequence_plot_sample_rate)
 
+    def _channels_to_stop(self):
+        # Double buffered channels keep playing until they run again
+        return [channel for channel in self.channel_update_list if not channel.double_buffered]
+
+    def stop_updated_channels(self):
+        self.for_each_channel(lambda channel: channel.stop(), self._channels_to_stop())
+
+    def for_each_channel(self, func, channels):
+        # Call func on each channel, at the same time on runtime.config.channel_workers
+        # threads if it is more than 1, and return the results once all calls are finished.
+        workers = self.runtime.config.channel_workers if self.runtime else 1
+        if workers <= 1 or len(channels) <= 1:
+            return [func(channel) for channel in channels]
+
+        if self._channel_executor_workers != workers:
+            if self._channel_executor is not None:
+                self._channel_executor.shutdown(wait=False)
+            self._channel_executor = ThreadPoolExecutor(workers,
+                                                        thread_name_prefix="channel_worker")
+            self._channel_executor_workers = workers
+
+        futures = [self._channel_executor.submit(func, channel) for channel in channels]
+        wait(futures)
+        return [future.result() for future in futures]
+
+    def close(self):
+        # Shut down the threads of for_each_channel(), they are started again if needed
+        if self._channel_executor is not None:
+            self._channel_executor.shutdown()
+            self._channel_executor = None
+            self._channel_executor_workers = 0
+
+    def __del__(self):
+        if getattr(self, "_channel_executor", None) is not None:
+            self._channel_executor.shutdown(wait=False)
+
     def stop_channels(self):
-        for channel_name, channel in self.channels.items():
-            channel.stop()
+        self.for_each_channel(lambda channel: channel.stop(), list(self.channels.values()))
+        self._stopped_channels = dict.fromkeys(self.channels.values())
 
-    def run_channels(self):
+    async def stop_channels_async(self):
+        await asyncio.gather(*(channel.stop_async() for channel in self.channels.values()))
+        self._stopped_channels = dict.fromkeys(self.channels.values())
+
+    def _check_ready_to_run(self):
         assert self.channels, 'No channel connected to this sequence. Did you' \
                               'properly set up the trigger and link waveform ' \
                               'channels to it?'
         assert self.slices, 'No slice defined in this sequence. Did you add ' \
                             'slices to this sequence?'
         assert self.last_compiled_waveforms, 'Please run setup_channels() first!'
-        for channel, waveform in self.last_compiled_waveforms.items():
-            if channel in self.channel_update_list:
-                channel.run()
+
+    def upload_channels(self):
+        # Upload the channels set up by setup_channels(), without starting them
+        self.for_each_channel(lambda channel: channel.upload(), self.channel_update_list)
+
+    async def upload_channels_async(self):
+        await asyncio.gather(*(channel.upload_async() for channel in self.channel_update_list))
+
+    def run_channels(self):
+        self._check_ready_to_run()
+        # All channels are uploaded before any of them starts
+        self.upload_channels()
+        self.for_each_channel(lambda channel: channel.run(), self.channel_update_list)
+
+    async def run_channels_async(self):
+        self._check_ready_to_run()
+        await self.upload_channels_async()
+        await asyncio.gather(*(channel.run_async() for channel in self.channel_update_list))
 
     def send_sequence_plot(self, plot_sample_rate=1e6, force=False, send_async=True):
         if not force and not self.runtime.config.show_sequence:
@@ -1,6 +1,7 @@
 from enum import Enum
 
 from thunderq.waveforms.native import Waveform, Blank
+from thunderq.helper.version import next_version
 
 
 class PaddingPosition(Enum):
@@ -9,88 +10,107 @@ class PaddingPosition(Enum):
 
 
 class Slice:
+    # Change tracking: each slice keeps the channels changed in it or below since the last
+    # clear_channel_updated_flag() in _dirty_channels, and the channels it has waveforms for
+    # (in it or below) in _channels. Both are dicts used as ordered sets, updated on each
+    # change and passed on to the parent, so none of them is found by walking the tree.
+    # Sub slices that changed are kept in _changed_sub_slices, their durations are compared
+    # with the last ones when the updated channels are asked for.
+    # Each change also takes a new version (see helper.version), which is passed on to the
+    # parents, so the version of a slice is the latest one in it or below, and a slice that
+    # didn't change since version N is told by version <= N, without looking into it.
     def __init__(self, name):
         self.name = name
         self.waveforms = {}
-        self._channel_updated = []
         self.sub_slices = []
         self.processed_waveforms = {}
+        self.parent = None
 
+        self._dirty_channels = {}
+        self._channels = {}
+        self._changed_sub_slices = {}
         self._sub_slices_length_history = {}
-        self._total_channel_updated = []
-        self._compiled = False
-        self._yet_recompute_channel_update = True
+        self.version = next_version()
+        self._flattened_version = None
 
     @property
     def duration(self):
         raise NotImplementedError
 
-    def need_recompute_updated_channels(self):
-        if self._yet_recompute_channel_update:
-            return True
-
-        for sub_slice in self.sub_slices:
-            if sub_slice.need_recompute_updated_channels():
-                return True
-
-        return False
-
     def get_updated_channel(self):
-        # First scan, check which channel needs to be updated
-        if not self.need_recompute_updated_channels():
-            return self._total_channel_updated
-
-        channel_updated = []
-        channel_updated.extend(self._channel_updated)
-        already_add_all_channels = False
-        for sub_slice in self.sub_slices:
-            if sub_slice.duration != self._sub_slices_length_history[sub_slice]:
-                # As long as one flex slice stretched, update all channels
-                self._sub_slices_length_history[sub_slice] = sub_slice.duration
-                self._compiled = False
-                if not already_add_all_channels:
-                    for channel in self.get_channels():
-                        if channel not in channel_updated:
-                            channel_updated.append(channel)
-                    already_add_all_channels = True
-                continue
-            sub_updated = sub_slice.get_updated_channel()
-            if sub_updated:
-                self._compiled = False
-                for channel in sub_updated:
-                    if channel not in channel_updated:
-                        channel_updated.append(channel)
-
-        self._total_channel_updated = channel_updated
-        self._yet_recompute_channel_update = False
-        return channel_updated
+        self._check_stretched_sub_slices()
+        return list(self._dirty_channels)
+
+    def _check_stretched_sub_slices(self):
+        for sub_slice in self._changed_sub_slices:
+            sub_slice._check_stretched_sub_slices()
+            self._dirty_channels.update(sub_slice._dirty_channels)
+
+            duration = sub_slice.duration
+            if duration != self._sub_slices_length_history[sub_slice]:
+                # As long as one sub slice stretched, the waveforms after it move, and the
+                # padding of those before it changes: update the channels of the sub slices.
+                # Waveforms of this slice itself stay as they are. The sequence tells which
+                # of the channels really changed, see Sequence.compile_waveforms().
+                self._sub_slices_length_history[sub_slice] = duration
+                self._dirty_channels.update((channel, None) for channel in self._channels
+                                            if channel not in self.waveforms)
+        self._changed_sub_slices = {}
 
     def clear_channel_updated_flag(self):
-        self._yet_recompute_channel_update = True
-        self._channel_updated = []
+        self._check_stretched_sub_slices()
+        if not self._dirty_channels:
+            # Nothing changed below either
+            return
+
+        self._dirty_channels = {}
         for sub_slice in self.sub_slices:
             sub_slice.clear_channel_updated_flag()
 
-    def set_channel_updated_flag(self, channel):
-        self._yet_recompute_channel_update = True
-        self._channel_updated.append(channel)
-        self._total_channel_updated = []
-        self._compiled = False
+    def _mark_channels_updated(self, channels, version=None):
+        if version is None:
+            version = next_version()
+        self._dirty_channels.update(dict.fromkeys(channels))
+        self.version = version
+        if self.parent:
+            self.parent._changed_sub_slices[self] = None
+            self.parent._mark_channels_updated(channels, version)
+
+    def _update_channels(self):
+        # Rebuild _channels after a channel may have been removed, here and above
+        channels = {}
+        for sub_slice in self.sub_slices:
+            channels.update(sub_slice._channels)
+        channels.update(dict.fromkeys(self.waveforms))
+        self._channels = channels
+        if self.parent:
+            self.parent._update_channels()
+
+    def _add_channel(self, channel):
+        if channel in self._channels:
+            return
+        self._channels[channel] = None
+        if self.parent:
+            self.parent._add_channel(channel)
 
+    def set_channel_updated_flag(self, channel):
         if channel in self.processed_waveforms:
             del self.processed_waveforms[channel]
 
-    def add_waveform(self, channel, waveform: Waveform):
-        self.set_channel_updated_flag(channel)
+        self._mark_channels_updated((channel,))
 
+    def add_waveform(self, channel, waveform: Waveform):
         if channel not in self.waveforms:
             self.waveforms[channel] = waveform
+            self._add_channel(channel)
         else:
             self.waveforms[channel] = \
                 self.waveforms[channel].concat(waveform)
 
+        self.set_channel_updated_flag(channel)
+
     def get_waveform(self, channel):
-        if not self._compiled:
+        if self._flattened_version != self.version:
             self.flatten_waveform()
         if channel in self.processed_waveforms:
             return self.processed_waveforms[channel]
@@ -98,36 +118,31 @@ class Slice:
             return None
 
     def clear_waveform(self, channel):
-        self.set_channel_updated_flag(channel)
         if channel in self.waveforms:
             del self.waveforms[channel]
-            self._compiled = False
+            self._update_channels()
+        self.set_channel_updated_flag(channel)
 
     def get_channels(self):
-        channels = []
-        for sub_slice in self.sub_slices:
-            for ch in sub_slice.get_channels():
-                if ch not in channels:
-                    channels.append(ch)
-
-        for ch in self.waveforms.keys():
-            if ch not in channels:
-                channels.append(ch)
-
-        return channels
+        return list(self._channels)
 
     def add_sub_slice(self, sub_slice):
         assert isinstance(sub_slice, Slice)
+        assert sub_slice.parent is None, f"Slice {sub_slice.name} already has a parent."
         self.sub_slices.append(sub_slice)
-        self._sub_slices_length_history[sub_slice] = 0
+        sub_slice.parent = self
+        self._sub_slices_length_history[sub_slice] = sub_slice.duration
 
-        self._compiled = False
-        self._total_channel_updated = {}
+        for channel in sub_slice._channels:
+            self._add_channel(channel)
+        self._mark_channels_updated(self._channels)
 
         return self
 
     def flatten_waveform(self):
-        channel_updated = self.get_updated_channel()
+        self._check_stretched_sub_slices()
+        self._flattened_version = self.version
+        channel_updated = self._dirty_channels
 
         if not channel_updated:
             # If no waveform change detected,
@@ -150,7 +165,7 @@ class Slice:
                     f"Waveform for channel {channel} defined in both parent "\
                     "slice and sub slice, causing conflicts."
 
-                if channel not in sub_slice.get_channels():
+                if channel not in sub_slice._channels:
                     pointer += sub_slice.duration
                     continue
 
@@ -181,22 +196,32 @@ class Slice:
                     processed_sub_waveforms[channel] = \
                         processed_sub_waveforms[channel].concat(Blank(padding_len))
 
-        self.processed_waveforms = processed_self_waveforms
+        # Waveforms of channels that are not updated are kept
+        for channel in channel_updated:
+            self.processed_waveforms.pop(channel, None)
+        self.processed_waveforms.update(processed_self_waveforms)
         self.processed_waveforms.update(processed_sub_waveforms)
 
-        self._compiled = True
-
 
 class FlexSlice(Slice):
     def __init__(self, name):
         super().__init__(name)
+        self._duration = 0
+        self._duration_version = None
 
     @property
     def duration(self):
-        max_waveform_len = max([waveform.width for waveform in self.waveforms.values()])
+        # Kept until anything in the slice or below changes, which bumps self.version
+        if self._duration_version == self.version:
+            return self._duration
+
+        max_waveform_len = max([waveform.width for waveform in self.waveforms.values()],
+                               default=0)
         max_slice_len = sum([slice.duration for slice in self.sub_slices]) \
             if self.sub_slices else 0
-        return max(max_slice_len, max_waveform_len)
+        self._duration = max(max_slice_len, max_waveform_len)
+        self._duration_version = self.version
+        return self._duration
 
     def add_sub_slice(self, sub_slice):
         assert not isinstance(sub_slice, FixedSlice), \
@@ -220,7 +245,7 @@ class FixedLengthSlice(Slice):
     def flatten_waveform(self):
         super().flatten_waveform()
 
-        for channel in self.get_updated_channel():
+        for channel in self._dirty_channels:
             if channel not in self.processed_waveforms:
                 continue
             waveform_width = self.processed_waveforms[channel].width
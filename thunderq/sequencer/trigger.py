@@ -1,3 +1,6 @@
+import asyncio
+
+
 class Trigger:
     def __init__(self):
         pass
@@ -8,6 +11,13 @@ class Trigger:
     def set_channel_delay(self, channel, raise_at, drop_after):
         raise NotImplementedError
 
+    # Awaitable counterparts, device calls are run in the event loop's default executor
+    async def set_cycle_frequency_async(self, freq):
+        await asyncio.to_thread(self.set_cycle_frequency, freq)
+
+    async def set_channel_delay_async(self, channel, raise_at, drop_after):
+        await asyncio.to_thread(self.set_channel_delay, channel, raise_at, drop_after)
+
 
 # device_repo DG support
 class DGTrigger(Trigger):
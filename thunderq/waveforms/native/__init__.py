@@ -1,2 +1,6 @@
 from thunderq.waveforms.native.waveform import (Waveform, SumWave, CarryWave, Sequence, Sin, Cos,
                                                 ComplexExp, DC, Blank, CalibratedIQ, Real, Imag)
+from thunderq.waveforms.native.sample_cache import SampleCache, default_sample_cache
+from thunderq.waveforms.native.analysis import (runs, sample_runs, constant_value, content_range,
+                                                differing_range, segment_bounds)
+from thunderq.waveforms.native.optimizer import simplify
@@ -0,0 +1,310 @@
+# waveforms.native.analysis
+# -------------------------
+# Finds the regions where a waveform is constant.
+# Note:
+# 1. runs() describes a waveform as a list of (start, end, value) covering [0, width), where
+#     value is the constant value within [start, end), or None if the waveform isn't constant
+#     there. Adjacent runs never have the same value.
+# 2. Sampling uses the runs to fill constant regions with a single slice assignment, and
+#     consumers of sampled data (uploaders, plotters) can use sample_runs() to skip or compress
+#     these regions, most of a cycle being Blank padding.
+# 3. content_range() and differing_range() tell where waveforms are non-zero or differ, so
+#     that padding which only grows or moves doesn't count as a change.
+# 4. segment_bounds() lists where waveforms in a tree start and end. Samples next to these
+#     may round to either side, so samples that moved across time can't be trusted there.
+#
+
+import numpy as np
+
+from thunderq.waveforms.native.waveform import (Waveform, SumWave, CarryWave, Sequence, Sin, Cos,
+                                                ComplexExp, DC, Blank, Gaussian, CalibratedIQ,
+                                                Real, Imag)
+
+
+def clips_itself(waveform: Waveform):
+    # CalibratedIQ, Real and Imag don't limit themselves to their own width: they may be
+    # non-zero outside of [0, width), unless their parent clips them.
+    return type(waveform) not in (CalibratedIQ, Real, Imag)
+
+
+def _append_run(runs, start, end, value):
+    if end <= start:
+        return
+    if runs and runs[-1][2] is None and value is None:
+        runs[-1] = (runs[-1][0], end, None)
+    elif runs and runs[-1][2] is not None and value is not None and runs[-1][2] == value:
+        runs[-1] = (runs[-1][0], end, value)
+    else:
+        runs.append((start, end, value))
+
+
+def _combine_runs(wave1, runs1, wave2, runs2, width, func):
+    # Walk both run lists at once, combining values of overlapping runs with func.
+    # Runs are extended up to width, with zeros if the waveform clips itself.
+    runs1 = runs1 + [(runs1[-1][1] if runs1 else 0, width, 0 if clips_itself(wave1) else None)]
+    runs2 = runs2 + [(runs2[-1][1] if runs2 else 0, width, 0 if clips_itself(wave2) else None)]
+
+    combined = []
+    i = j = 0
+    start = 0
+    while i < len(runs1) and j < len(runs2):
+        end = min(runs1[i][1], runs2[j][1])
+        _append_run(combined, start, end, func(runs1[i][2], runs2[j][2]))
+        start = end
+        if runs1[i][1] == end:
+            i += 1
+        if runs2[j][1] == end:
+            j += 1
+
+    return combined
+
+
+def _sum(value1, value2):
+    if value1 is None or value2 is None:
+        return None
+    return value1 + value2
+
+
+def _product(value1, value2):
+    if (value1 is not None and value1 == 0) or (value2 is not None and value2 == 0):
+        return 0
+    if value1 is None or value2 is None:
+        return None
+    return value1 * value2
+
+
+def _leaf_value(waveform):
+    waveform_type = type(waveform)
+    if waveform_type in (DC, Blank):
+        return waveform.value()
+    elif waveform_type in (Sin, Cos, Gaussian) and waveform.amplitude == 0:
+        return 0
+    elif waveform_type in (Sin, Cos, ComplexExp) and waveform.omega == 0:
+        return waveform._kernel(np.zeros(1))[0]
+    return None
+
+
+def runs(waveform: Waveform, memo=None):
+    # memo: optional dict, which keeps results of each node by id() across calls
+    if memo is not None and id(waveform) in memo:
+        return memo[id(waveform)]
+
+    result = []
+    waveform_type = type(waveform)
+    if waveform_type in (DC, Blank, Sin, Cos, ComplexExp, Gaussian):
+        _append_run(result, 0, waveform.width, _leaf_value(waveform))
+
+    elif waveform_type is Sequence:
+        start_at = waveform.each_waveform_start_at
+        for i, segment in enumerate(waveform.sequence):
+            offset, end = start_at[i], start_at[i + 1]
+            for run_start, run_end, value in runs(segment, memo):
+                _append_run(result, offset + run_start, min(offset + run_end, end), value)
+            if result and result[-1][1] < end:
+                _append_run(result, result[-1][1], end, 0)
+
+    elif waveform_type in (SumWave, CarryWave):
+        func = _sum if waveform_type is SumWave else _product
+        result = _combine_runs(waveform.wave1, runs(waveform.wave1, memo),
+                               waveform.wave2, runs(waveform.wave2, memo),
+                               waveform.width, func)
+
+    elif waveform_type in (Real, Imag):
+        for run_start, run_end, value in runs(waveform.complex_waveform, memo):
+            if value is not None:
+                value = np.real(value) if waveform_type is Real else np.imag(value)
+            _append_run(result, run_start, run_end, value)
+
+    else:
+        _append_run(result, 0, waveform.width, None)
+
+    if memo is not None:
+        memo[id(waveform)] = result
+    return result
+
+
+def constant_value(waveform: Waveform, memo=None):
+    # The value of waveform on [0, width) if it is constant there, otherwise None
+    waveform_runs = runs(waveform, memo)
+    if len(waveform_runs) == 1:
+        return waveform_runs[0][2]
+    return None
+
+
+def content_range(waveform: Waveform, memo=None):
+    # (start, end) of waveform without its leading and trailing zeros. start >= end if
+    # the waveform is zero everywhere.
+    waveform_runs = runs(waveform, memo)
+    first, last = 0, len(waveform_runs)
+    while first < last and _is_zero(waveform_runs[first][2]):
+        first += 1
+    while last > first and _is_zero(waveform_runs[last - 1][2]):
+        last -= 1
+    if first == last:
+        return 0, 0
+    return waveform_runs[first][0], waveform_runs[last - 1][1]
+
+
+def _is_zero(value):
+    return value is not None and value == 0
+
+
+def differing_range(waveform: Waveform, reference: Waveform):
+    # (start, end) outside of which waveform and reference are equal, both being zero
+    # beyond their widths. start >= end if they are equal everywhere.
+    if waveform is reference or waveform == reference:
+        return 0, 0
+
+    start = 0
+    if type(waveform) is Sequence and type(reference) is Sequence:
+        # Skip the segments both sequences begin with
+        start_at = waveform.each_waveform_start_at
+        reference_start_at = reference.each_waveform_start_at
+        for i, (segment, reference_segment) in enumerate(zip(waveform.sequence,
+                                                              reference.sequence)):
+            if start_at[i + 1] != reference_start_at[i + 1] or \
+                    not (segment is reference_segment or segment == reference_segment):
+                break
+            start = start_at[i + 1]
+
+    ranges = [content_range(waveform), content_range(reference)]
+    ranges = [(first, last) for first, last in ranges if first < last]
+    if not ranges:
+        return 0, 0
+    start = max(start, min(first for first, _ in ranges))
+    end = max(last for _, last in ranges)
+    if start >= end:
+        return 0, 0
+    return start, end
+
+
+def _segment_bounds(waveform, offset, bounds):
+    waveform_type = type(waveform)
+    bounds.add(offset)
+    bounds.add(offset + waveform.width)
+
+    if waveform_type is Sequence:
+        for segment, start in zip(waveform.sequence, waveform.each_waveform_start_at):
+            _segment_bounds(segment, offset + start, bounds)
+    elif waveform_type in (SumWave, CarryWave):
+        _segment_bounds(waveform.wave1, offset, bounds)
+        _segment_bounds(waveform.wave2, offset, bounds)
+    elif waveform_type in (Real, Imag):
+        _segment_bounds(waveform.complex_waveform, offset, bounds)
+    elif waveform_type is CalibratedIQ:
+        # carry_IQ is read at time + shift
+        for shift in {waveform.left_shift_I, waveform.left_shift_Q}:
+            _segment_bounds(waveform.carry_IQ, offset - shift, bounds)
+
+
+def segment_bounds(waveform: Waveform):
+    # Sorted times at which waveform, or any waveform in it, starts or ends
+    bounds = set()
+    _segment_bounds(waveform, 0, bounds)
+    return sorted(bounds)
+
+
+def _first_sample_at(time, sample_rate, sample_count):
+    # Index of the first sample at or after time, sample i being at i * (1 / sample_rate)
+    sample_interval = 1.0 / sample_rate
+    index = min(max(int(np.ceil(time / sample_interval)), 0), sample_count)
+    if index > 0 and (index - 1) * sample_interval >= time:
+        index -= 1
+    elif index < sample_count and index * sample_interval < time:
+        index += 1
+    return index
+
+
+def sample_runs(waveform: Waveform, sample_rate):
+    # runs() in terms of sample indices: a list of (first, last + 1, value), as sampled
+    # by Waveform.direct_sample(). Bounds are computed from the run times, without an array
+    # of all sample points.
+    sample_count = waveform.sample_length(sample_rate)
+    waveform_runs = runs(waveform)
+    bounds = [_first_sample_at(run[0], sample_rate, sample_count) for run in waveform_runs]
+    bounds.append(sample_count)
+
+    result = []
+    for (_, _, value), first, last in zip(waveform_runs, bounds[:-1], bounds[1:]):
+        _append_run(result, int(first), int(last), value)
+    return result
+
+
+# Ratio of two waveforms which are both zero everywhere, any ratio fits
+_ANY_RATIO = "any"
+
+
+def _merge_ratios(ratio1, ratio2):
+    if ratio1 is _ANY_RATIO:
+        return ratio2
+    if ratio2 is _ANY_RATIO:
+        return ratio1
+    if ratio1 is None or ratio2 is None:
+        return None
+    if abs(ratio1 - ratio2) > 1e-12 * max(abs(ratio1), abs(ratio2)):
+        return None
+    return ratio1
+
+
+def _ratio(waveform, reference):
+    waveform_type = type(waveform)
+    if waveform_type is not type(reference):
+        return None
+
+    if waveform_type in (SumWave, CarryWave):
+        ratio1 = _ratio(waveform.wave1, reference.wave1)
+        ratio2 = _ratio(waveform.wave2, reference.wave2)
+        if waveform_type is SumWave:
+            return _merge_ratios(ratio1, ratio2)
+        if ratio1 is _ANY_RATIO or ratio2 is _ANY_RATIO:
+            return _ANY_RATIO
+        if ratio1 is None or ratio2 is None:
+            return None
+        return ratio1 * ratio2
+
+    elif waveform_type is Sequence:
+        if waveform.each_waveform_start_at != reference.each_waveform_start_at:
+            return None
+        ratio = _ANY_RATIO
+        for segment, reference_segment in zip(waveform.sequence, reference.sequence):
+            ratio = _merge_ratios(ratio, _ratio(segment, reference_segment))
+            if ratio is None:
+                return None
+        return ratio
+
+    elif waveform_type in (Real, Imag, CalibratedIQ):
+        if waveform_type is CalibratedIQ:
+            child, reference_child = waveform.carry_IQ, reference.carry_IQ
+            if (waveform.left_shift_I, waveform.left_shift_Q, waveform.scale_I, waveform.scale_Q) != \
+                    (reference.left_shift_I, reference.left_shift_Q,
+                     reference.scale_I, reference.scale_Q):
+                return None
+        else:
+            child, reference_child = waveform.complex_waveform, reference.complex_waveform
+        ratio = _ratio(child, reference_child)
+        if ratio is None or ratio is _ANY_RATIO or np.imag(ratio) == 0:
+            return ratio
+        return None
+
+    elif waveform_type in (DC, Blank, Sin, Cos, Gaussian):
+        key = waveform.structural_key()
+        reference_key = reference.structural_key()
+        if key == reference_key:
+            return _ANY_RATIO if _leaf_value(waveform) == 0 else 1
+
+        # Everything but the amplitude has to be equal
+        attributes = [attr for attr in waveform_type._key_attributes if attr != "amplitude"]
+        if any(getattr(waveform, attr) != getattr(reference, attr) for attr in attributes):
+            return None
+        if reference.amplitude == 0:
+            return None
+        return waveform.amplitude / reference.amplitude
+
+    return 1 if waveform == reference else None
+
+
+def amplitude_ratio(waveform: Waveform, reference: Waveform):
+    # The factor r with waveform == reference * r for all times, found by comparing the
+    # trees, or None if there is no such factor (or it can't be told without sampling).
+    ratio = _ratio(waveform, reference)
+    return 1 if ratio is _ANY_RATIO else ratio
@@ -0,0 +1,326 @@
+# waveforms.native.compiler
+# -------------------------
+# Lowers a waveform tree into a flat program, which is evaluated in a single pass over a
+# preallocated output buffer.
+# Note:
+# 1. Each instruction works on a time interval and a register. Registers are full-length
+#     buffers: register 0 is the output, the others are scratch buffers, which are reused
+#     between instructions, and kept by each thread for later evaluations.
+# 2. Composite waveforms don't materialize their children if they can avoid it: SumWave
+#     children accumulate into the same register, CarryWave children multiply into it,
+#     and Sequence segments write their own index range of it.
+# 3. Nodes proven constant by waveforms.native.analysis (DC, Blank, and e.g. a Sequence of
+#     equal DCs) fill their index range with a single slice operation, zeros are skipped.
+# 4. Sample times are expected to be sorted, like the ones generated by np.arange().
+#     Unsorted times work, but are sorted first.
+#
+
+import threading
+
+import numpy as np
+
+from thunderq.waveforms.native.waveform import (Waveform, SumWave, CarryWave, Sequence, Sin, Cos,
+                                                ComplexExp, DC, Blank, Gaussian, CalibratedIQ,
+                                                Real, Imag)
+from thunderq.waveforms.native.analysis import runs
+
+ADD = 0
+MUL = 1
+
+
+def _combine(target, values, mode):
+    if mode == ADD:
+        target += values
+    else:
+        target *= values
+
+
+def _op_zero(times, index_range, registers, reg, t0, t1):
+    i0, i1 = index_range(t0, t1)
+    registers[reg][i0:i1] = 0
+
+
+def _op_constant(times, index_range, registers, reg, t0, t1, mode, value):
+    i0, i1 = index_range(t0, t1)
+    _combine(registers[reg][i0:i1], value, mode)
+
+
+def _op_kernel(times, index_range, registers, reg, t0, t1, mode, kernel, offset):
+    i0, i1 = index_range(t0, t1)
+    if i0 == i1:
+        return
+    _combine(registers[reg][i0:i1], kernel(times[i0:i1] - offset), mode)
+
+
+def _op_move(times, index_range, registers, reg, t0, t1, mode, src, part, factor):
+    i0, i1 = index_range(t0, t1)
+    if i0 == i1:
+        return
+
+    values = registers[src][i0:i1]
+    if part == "real":
+        values = values.real
+    elif part == "imag":
+        values = values.imag
+    if factor != 1:
+        values = values * factor
+
+    _combine(registers[reg][i0:i1], values, mode)
+
+
+def is_complex(waveform: Waveform):
+    # Whether samples of the waveform may have an imaginary part
+    waveform_type = type(waveform)
+    if waveform_type in (Sin, Cos, Gaussian):
+        return np.iscomplexobj(waveform.amplitude)
+    elif waveform_type in (DC, Blank):
+        return np.iscomplexobj(waveform.value())
+    elif waveform_type in (SumWave, CarryWave):
+        return is_complex(waveform.wave1) or is_complex(waveform.wave2)
+    elif waveform_type is Sequence:
+        return any(is_complex(segment) for segment in waveform.sequence)
+    elif waveform_type in (Real, Imag):
+        return False
+
+    return True  # ComplexExp, CalibratedIQ, and anything we don't know
+
+
+_scratch_pool = threading.local()
+
+
+def _scratch_registers(dtypes, length):
+    # Scratch buffers are kept per thread and shared by all programs
+    pool = getattr(_scratch_pool, "buffers", None)
+    if pool is None:
+        pool = _scratch_pool.buffers = {}
+
+    registers = []
+    used = {}
+    for dtype in dtypes:
+        buffers = pool.setdefault(dtype, [])
+        i = used.get(dtype, 0)
+        used[dtype] = i + 1
+
+        if i == len(buffers):
+            buffers.append(np.empty(length, dtype=dtype))
+        elif len(buffers[i]) < length:
+            buffers[i] = np.empty(length, dtype=dtype)
+        registers.append(buffers[i][:length])
+
+    return registers
+
+
+class WaveformProgram:
+    def __init__(self, instructions, scratch_dtypes, dtype):
+        self.instructions = instructions
+        self.scratch_dtypes = scratch_dtypes  # dtype of register i + 1
+        self.dtype = dtype
+
+    def evaluate(self, times, out=None):
+        times = np.asarray(times, dtype=float)
+
+        order = None
+        if len(times) > 1 and (times[1:] < times[:-1]).any():
+            order = np.argsort(times, kind="stable")
+            times = times[order]
+
+        if out is None or order is not None or \
+                (np.dtype(self.dtype).kind == 'c' and not np.iscomplexobj(out)):
+            result = np.zeros(len(times), dtype=self.dtype)
+        else:
+            assert len(out) == len(times)
+            result = out
+            result.fill(0)
+
+        index_ranges = {}
+
+        def index_range(t0, t1):
+            if (t0, t1) not in index_ranges:
+                index_ranges[(t0, t1)] = np.searchsorted(times, (t0, t1), side="left")
+            return index_ranges[(t0, t1)]
+
+        registers = [result] + _scratch_registers(self.scratch_dtypes, len(times))
+        for instruction in self.instructions:
+            instruction[0](times, index_range, registers, *instruction[1:])
+
+        if order is not None:
+            unsorted = np.empty_like(result)
+            unsorted[order] = result
+            result = unsorted
+
+        if out is not None and result is not out:
+            out[:] = result if np.iscomplexobj(out) else result.real
+            result = out
+
+        return result
+
+
+class _Compiler:
+    def __init__(self):
+        self.instructions = []
+        self.scratch_dtypes = []
+        self._free_registers = []
+        self._runs_memo = {}
+
+    def emit(self, *instruction):
+        self.instructions.append(instruction)
+
+    def acquire(self, dtype, t0, t1):
+        # Get a scratch register which is zero within [t0, t1)
+        for reg in self._free_registers:
+            if self.scratch_dtypes[reg - 1] == dtype:
+                self._free_registers.remove(reg)
+                break
+        else:
+            self.scratch_dtypes.append(dtype)
+            reg = len(self.scratch_dtypes)
+
+        self.emit(_op_zero, reg, t0, t1)
+        return reg
+
+    def release(self, reg):
+        self._free_registers.append(reg)
+
+    def lower_via_scratch(self, lower_func, waveform, offset, t0, t1, reg, mode):
+        # Evaluate into a scratch register first, then combine it into reg
+        scratch = self.acquire(complex if is_complex(waveform) else float, t0, t1)
+        lower_func(waveform, offset, t0, t1, scratch, ADD)
+        self.emit(_op_move, reg, t0, t1, mode, scratch, None, 1)
+        self.release(scratch)
+
+    def lower(self, waveform: Waveform, offset, t0, t1, reg, mode):
+        # Emit instructions that combine (add or multiply) the waveform into register
+        # reg within [t0, t1), where the waveform is evaluated at (time - offset).
+        # CalibratedIQ, Real and Imag don't limit themselves to their own width
+        if type(waveform) is CalibratedIQ:
+            self.lower_calibrated_iq(waveform, offset, t0, t1, reg, mode)
+            return
+        elif type(waveform) in (Real, Imag):
+            self.lower_part(waveform, offset, t0, t1, reg, mode)
+            return
+
+        s0 = max(t0, offset)
+        s1 = min(t1, offset + waveform.width)
+
+        if mode == MUL:
+            # Outside of its support the waveform is zero
+            if s0 >= s1:
+                self.emit(_op_zero, reg, t0, t1)
+                return
+            if t0 < s0:
+                self.emit(_op_zero, reg, t0, s0)
+            if s1 < t1:
+                self.emit(_op_zero, reg, s1, t1)
+
+        if s0 >= s1:
+            return
+
+        waveform_type = type(waveform)
+        waveform_runs = runs(waveform, self._runs_memo)
+        if len(waveform_runs) == 1 and waveform_runs[0][2] is not None:
+            value = waveform_runs[0][2]
+            if value != 0 or mode == MUL:
+                self.emit(_op_constant, reg, s0, s1, mode, value)
+
+        elif waveform_type in (SumWave, CarryWave) and len(waveform_runs) > 1:
+            # Only evaluate the children where the result isn't constant, e.g. where
+            # a gate is open
+            for start, end, value in waveform_runs:
+                r0 = max(s0, offset + start)
+                r1 = min(s1, offset + end)
+                if r0 >= r1:
+                    continue
+                if value is None:
+                    self.lower_composite(waveform, offset, r0, r1, reg, mode)
+                elif value != 0 or mode == MUL:
+                    self.emit(_op_constant, reg, r0, r1, mode, value)
+
+        elif waveform_type in (Sin, Cos, ComplexExp, Gaussian):
+            self.emit(_op_kernel, reg, s0, s1, mode, waveform._kernel, offset)
+
+        elif waveform_type in (SumWave, CarryWave):
+            self.lower_composite(waveform, offset, s0, s1, reg, mode)
+
+        elif waveform_type is Sequence:
+            start_at = waveform.each_waveform_start_at
+            for i, segment in enumerate(waveform.sequence):
+                seg_t0 = max(s0, offset + start_at[i])
+                seg_t1 = min(s1, offset + start_at[i + 1])
+                if seg_t0 < seg_t1:
+                    self.lower(segment, offset + start_at[i], seg_t0, seg_t1, reg, mode)
+
+        else:
+            # Waveforms we don't know, use its own vectorized implementation
+            self.emit(_op_kernel, reg, s0, s1, mode, waveform.at_array, offset)
+
+    def lower_composite(self, waveform, offset, t0, t1, reg, mode):
+        # SumWave or CarryWave within [t0, t1), which is inside of its support
+        if type(waveform) is SumWave:
+            if mode == ADD:
+                self.lower(waveform.wave1, offset, t0, t1, reg, ADD)
+                self.lower(waveform.wave2, offset, t0, t1, reg, ADD)
+            else:
+                self.lower_via_scratch(self.lower, waveform, offset, t0, t1, reg, mode)
+
+        elif mode == MUL:
+            self.lower(waveform.wave1, offset, t0, t1, reg, MUL)
+            self.lower(waveform.wave2, offset, t0, t1, reg, MUL)
+        else:
+            scratch = self.acquire(complex if is_complex(waveform) else float, t0, t1)
+            self.lower(waveform.wave1, offset, t0, t1, scratch, ADD)
+            self.lower(waveform.wave2, offset, t0, t1, scratch, MUL)
+            self.emit(_op_move, reg, t0, t1, ADD, scratch, None, 1)
+            self.release(scratch)
+
+    def lower_part(self, waveform, offset, t0, t1, reg, mode):
+        part = "real" if type(waveform) is Real else "imag"
+        child = waveform.complex_waveform
+        if type(child) is CalibratedIQ:
+            # Only evaluate the half of the calibrated waveform that is used
+            if mode == MUL:
+                self.lower_via_scratch(self.lower_part, waveform, offset, t0, t1, reg, mode)
+            else:
+                scale = child.scale_I if part == "real" else child.scale_Q
+                self.lower_iq_parts(child, offset, t0, t1, reg, ((part, scale),))
+        elif is_complex(child):
+            scratch = self.acquire(complex, t0, t1)
+            self.lower(child, offset, t0, t1, scratch, ADD)
+            self.emit(_op_move, reg, t0, t1, mode, scratch, part, 1)
+            self.release(scratch)
+        elif part == "real":
+            self.lower(child, offset, t0, t1, reg, mode)
+        elif mode == MUL:
+            self.emit(_op_zero, reg, t0, t1)
+
+    def lower_calibrated_iq(self, waveform: CalibratedIQ, offset, t0, t1, reg, mode):
+        if mode == MUL:
+            self.lower_via_scratch(self.lower_calibrated_iq, waveform, offset, t0, t1, reg, mode)
+            return
+
+        # I = Re(carry_IQ(t + left_shift_I)) * scale_I, Q = Im(carry_IQ(t + left_shift_Q)) * scale_Q
+        self.lower_iq_parts(waveform, offset, t0, t1, reg,
+                            (("real", waveform.scale_I), ("imag", 1j * waveform.scale_Q)))
+
+    def lower_iq_parts(self, waveform: CalibratedIQ, offset, t0, t1, reg, parts):
+        # Add each (part, factor) of the shifted carry_IQ into reg. The carry wave is
+        # evaluated once for both parts if they share the same shift.
+        scratch = self.acquire(complex, t0, t1)
+        evaluated_shift = None
+        for part, factor in parts:
+            shift = waveform.left_shift_I if part == "real" else waveform.left_shift_Q
+            if shift != evaluated_shift:
+                if evaluated_shift is not None:
+                    self.emit(_op_zero, scratch, t0, t1)
+                self.lower(waveform.carry_IQ, offset - shift, t0, t1, scratch, ADD)
+                evaluated_shift = shift
+            self.emit(_op_move, reg, t0, t1, ADD, scratch, part, factor)
+        self.release(scratch)
+
+
+def compile_waveform(waveform: Waveform) -> WaveformProgram:
+    compiler = _Compiler()
+    compiler.lower(waveform, 0, -np.inf, np.inf, 0, ADD)
+
+    return WaveformProgram(compiler.instructions,
+                           compiler.scratch_dtypes,
+                           complex if is_complex(waveform) else float)
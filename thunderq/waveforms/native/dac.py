@@ -0,0 +1,85 @@
+# waveforms.native.dac
+# -------------------------
+# Samples waveforms straight into device DAC format.
+# Note:
+# 1. quantize() normalizes and quantizes samples in bulk into the caller's buffer, block by
+#     block through a small work buffer, which is kept by each thread. Callers that keep
+#     their own float64 samples (e.g. AWGChannel) quantize these into their buffer directly.
+# 2. sample_into() evaluates the waveform into a float64 sample buffer first, which is kept
+#     by each thread as well. Apart from the sample times, no other full-size arrays are
+#     created.
+# 3. Integer buffers (e.g. int16) are scaled to the full range of their dtype, symmetric
+#     around zero, float buffers (e.g. float32) to [-1, 1], like normalized_sample().
+#
+
+import threading
+
+import numpy as np
+
+_thread_buffers = threading.local()
+
+# Number of samples quantize() converts at once
+QUANTIZE_BLOCK_SIZE = 64 * 1024
+
+
+def _thread_buffer(name, length):
+    buffer = getattr(_thread_buffers, name, None)
+    if buffer is None or len(buffer) < length:
+        buffer = np.empty(length)
+        setattr(_thread_buffers, name, buffer)
+    return buffer[:length]
+
+
+def full_scale(dtype):
+    # The DAC code of the normalized value 1.0
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'i':
+        return np.iinfo(dtype).max
+    elif dtype.kind == 'f':
+        return 1.0
+
+    raise TypeError(f"Unsupported DAC sample type {dtype}")
+
+
+def quantize(data: np.ndarray, buffer: np.ndarray):
+    # Write data normalized to the DAC format of buffer into buffer[:len(data)], and return
+    # the amplitude (max_abs) that 1.0 stands for. data is left unchanged.
+    sample_count = len(data)
+    scale = full_scale(buffer.dtype)
+
+    max_abs = max(data.max(), -data.min()) if sample_count else 0
+    if max_abs == 0:
+        buffer[:sample_count] = 0
+        return 0
+
+    if buffer.dtype.kind == 'f':
+        np.multiply(data, scale / max_abs, out=buffer[:sample_count], casting="unsafe")
+        return max_abs
+
+    for first in range(0, sample_count, QUANTIZE_BLOCK_SIZE):
+        last = min(first + QUANTIZE_BLOCK_SIZE, sample_count)
+        work = _thread_buffer("work", last - first)
+        np.multiply(data[first:last], scale / max_abs, out=work)
+        np.rint(work, out=work)
+        np.clip(work, -scale, scale, out=work)
+        np.copyto(buffer[first:last], work, casting="unsafe")
+
+    return max_abs
+
+
+def sample_into(waveform, buffer: np.ndarray, sample_rate, min_unit=1):
+    # Write the normalized samples of the waveform into buffer[:sample_length], where
+    # sample_length = waveform.sample_length(sample_rate, min_unit), and return the
+    # amplitude (max_abs) that 1.0 stands for.
+    sample_count = waveform.sample_length(sample_rate)
+    sample_length = waveform.sample_length(sample_rate, min_unit)
+    if len(buffer) < sample_length:
+        raise ValueError(f"Buffer of {len(buffer)} samples is too short, "
+                         f"{sample_length} samples are needed.")
+    full_scale(buffer.dtype)  # Check the type before sampling
+
+    data = waveform.sample_range(sample_rate, 0, sample_count,
+                                 out=_thread_buffer("samples", sample_count))
+    buffer[sample_count:sample_length] = 0
+
+    return quantize(data, buffer)
@@ -0,0 +1,181 @@
+# waveforms.native.optimizer
+# -------------------------
+# Rewrites a waveform tree into a smaller, equivalent tree before it is sampled.
+# Note:
+# 1. simplify() never modifies its input, it returns a new tree which samples to the same
+#     values. Rules that can't be proven safe for a node are simply skipped.
+# 2. Sequences are flattened, zero-width segments are dropped and adjacent Blanks (or DCs with
+#     the same value) are merged. The start offsets of the remaining segments are taken from
+#     the original sequence, so the total width (and therefore the sample count) is unchanged.
+# 3. Constant factors are folded into amplitudes: CarryWave(DC, x) becomes x scaled by the DC
+#     value, padded with Blank if the DC is wider than x.
+#
+
+import numpy as np
+
+from thunderq.waveforms.native.waveform import (Waveform, SumWave, CarryWave, Sequence, Sin, Cos,
+                                                DC, Blank, Gaussian, CalibratedIQ, Real, Imag)
+from thunderq.waveforms.native.compiler import is_complex
+from thunderq.waveforms.native.analysis import constant_value, clips_itself
+
+
+def _is_zero(waveform):
+    value = constant_value(waveform)
+    return value is not None and value == 0
+
+
+def _as_constant(width, value, like=None):
+    # A Blank or DC of the given value, keeping the parameters of like if it's a DC already
+    if value == 0:
+        return Blank(width)
+    elif type(like) is DC:
+        return DC(width, like.amplitude, like.complex_phi)
+    return DC(width, value)
+
+
+def _padded(waveform, width):
+    # waveform followed by zeros up to width
+    if waveform.width >= width:
+        return waveform
+    return Sequence.from_segments([waveform, Blank(width - waveform.width)],
+                                  [0, waveform.width, width])
+
+
+def _scaled(waveform, factor):
+    # waveform * factor, or None if it can't be expressed by adjusting amplitudes
+    if factor == 1:
+        return waveform
+
+    waveform_type = type(waveform)
+    if waveform_type is Blank:
+        return waveform
+    elif waveform_type in (DC, Sin, Cos, Gaussian):
+        return waveform * factor
+    elif waveform_type is SumWave:
+        wave1 = _scaled(waveform.wave1, factor)
+        wave2 = _scaled(waveform.wave2, factor)
+        if wave1 is None or wave2 is None:
+            return None
+        return SumWave(wave1, wave2)
+    elif waveform_type is CarryWave:
+        wave1 = _scaled(waveform.wave1, factor)
+        if wave1 is not None:
+            return CarryWave(wave1, waveform.wave2)
+        wave2 = _scaled(waveform.wave2, factor)
+        if wave2 is not None:
+            return CarryWave(waveform.wave1, wave2)
+        return None
+    elif waveform_type is Sequence:
+        segments = [_scaled(segment, factor) for segment in waveform.sequence]
+        if any(segment is None for segment in segments):
+            return None
+        return Sequence.from_segments(segments, waveform.each_waveform_start_at)
+    elif np.iscomplexobj(factor):
+        return None
+    elif waveform_type in (Real, Imag):
+        child = _scaled(waveform.complex_waveform, factor)
+        return None if child is None else waveform_type(child)
+    elif waveform_type is CalibratedIQ:
+        return waveform._replace(scale_I=waveform.scale_I * factor,
+                                 scale_Q=waveform.scale_Q * factor)
+
+    return None
+
+
+def _simplify_sequence(waveform: Sequence):
+    segments = []
+    start_at = [0]
+    last_value = None  # constant_value() of segments[-1]
+
+    def push(segment, start, end):
+        nonlocal last_value
+        if end <= start:
+            return
+
+        value = constant_value(segment)
+        if segments and value is not None and last_value is not None and value == last_value:
+            segments[-1] = _as_constant(end - start_at[-2], value, segments[-1])
+            start_at[-1] = end
+            return
+
+        segments.append(segment)
+        start_at.append(end)
+        last_value = value
+
+    each_start_at = waveform.each_waveform_start_at
+    for i, segment in enumerate(waveform.sequence):
+        start, end = each_start_at[i], each_start_at[i + 1]
+        segment = simplify(segment)
+
+        if type(segment) is Sequence:
+            inner_segments = segment.sequence
+            inner_start_at = segment.each_waveform_start_at
+            for j, inner in enumerate(inner_segments):
+                inner_end = end if j == len(inner_segments) - 1 else start + inner_start_at[j + 1]
+                push(inner, start + inner_start_at[j], min(inner_end, end))
+        else:
+            push(segment, start, end)
+
+    if not segments:
+        return Blank(waveform.width)
+    if len(segments) == 1 and segments[0].width == waveform.width and clips_itself(segments[0]):
+        return segments[0]
+
+    return Sequence.from_segments(segments, start_at)
+
+
+def _simplify_carry(waveform: CarryWave):
+    wave1 = simplify(waveform.wave1)
+    wave2 = simplify(waveform.wave2)
+
+    if _is_zero(wave1) or _is_zero(wave2):
+        return Blank(waveform.width)
+
+    for factor, other in ((wave1, wave2), (wave2, wave1)):
+        value = constant_value(factor)
+        if value is not None and factor.width >= other.width and clips_itself(other):
+            scaled = _scaled(other, value)
+            if scaled is not None:
+                return _padded(scaled, waveform.width)
+
+    return CarryWave(wave1, wave2)
+
+
+def _simplify_sum(waveform: SumWave):
+    wave1 = simplify(waveform.wave1)
+    wave2 = simplify(waveform.wave2)
+
+    if _is_zero(wave1) and clips_itself(wave2):
+        return _padded(wave2, waveform.width)
+    if _is_zero(wave2) and clips_itself(wave1):
+        return _padded(wave1, waveform.width)
+
+    return SumWave(wave1, wave2)
+
+
+def simplify(waveform: Waveform) -> Waveform:
+    # Return an equivalent, canonicalized waveform tree
+    waveform_type = type(waveform)
+
+    if waveform_type is Sequence:
+        return _simplify_sequence(waveform)
+    elif waveform_type is CarryWave:
+        return _simplify_carry(waveform)
+    elif waveform_type is SumWave:
+        return _simplify_sum(waveform)
+    elif waveform_type in (Real, Imag):
+        child = simplify(waveform.complex_waveform)
+        if not is_complex(child):
+            return child if waveform_type is Real else Blank(child.width)
+        return waveform_type(child)
+    elif waveform_type is CalibratedIQ:
+        carry_IQ = simplify(waveform.carry_IQ)
+        if carry_IQ is waveform.carry_IQ:
+            return waveform
+        return waveform._replace(carry_IQ=carry_IQ)
+    elif waveform_type not in (DC, Blank):
+        value = constant_value(waveform)
+        if value is not None:
+            return _as_constant(waveform.width, value)
+
+    return waveform
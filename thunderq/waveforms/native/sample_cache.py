@@ -0,0 +1,92 @@
+# waveforms.native.sample_cache
+# -------------------------
+# A bounded LRU cache for sampled waveforms.
+# Note:
+# 1. Entries are keyed by the structural key of a waveform tree (see Waveform.structural_key)
+#     together with the sampling settings, so two waveforms with identical parameters share
+#     one entry, and changing any parameter leads to a different key.
+# 2. Cached arrays are made read-only, since the same array is handed to every caller.
+#
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class SampleCache:
+    def __init__(self, max_bytes=256 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()  # key -> (value, nbytes)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _freeze(value):
+        # Make all arrays in value read-only and count their size
+        nbytes = 0
+        arrays = value if isinstance(value, tuple) else (value,)
+        for item in arrays:
+            if isinstance(item, np.ndarray):
+                item.flags.writeable = False
+                nbytes += item.nbytes
+        return nbytes
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0]
+
+    def put(self, key, value):
+        nbytes = self._freeze(value)
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+
+            if nbytes > self.max_bytes:
+                return
+
+            self._entries[key] = (value, nbytes)
+            self.current_bytes += nbytes
+            self._evict()
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._entries:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self.current_bytes -= nbytes
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+default_sample_cache = SampleCache()
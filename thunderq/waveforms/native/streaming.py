@@ -0,0 +1,80 @@
+# waveforms.native.streaming
+# -------------------------
+# Samples long waveforms block by block, so memory use is bounded by the block size instead
+# of the length of the waveform.
+# Note:
+# 1. Normalizing needs the global max_abs before the first block is produced. It is found by
+#     a pre-pass that evaluates only the non-constant runs (see waveforms.native.analysis),
+#     also block by block. Constant runs contribute their value directly.
+# 2. Blocks are fresh arrays, the last one includes the min_unit padding. Their dtype may be
+#     a DAC format like in waveforms.native.dac.
+#
+
+import numpy as np
+
+from thunderq.waveforms.native.analysis import sample_runs
+from thunderq.waveforms.native.dac import full_scale
+
+
+class BlockSampler:
+    def __init__(self, waveform, sample_rate, block_size=1024 ** 2, min_unit=1,
+                 normalize=True, dtype=float):
+        assert block_size > 0
+        self.waveform = waveform
+        self.sample_rate = sample_rate
+        self.block_size = block_size
+        self.dtype = np.dtype(dtype)
+
+        self.sample_count = waveform.sample_length(sample_rate)
+        self.sample_length = waveform.sample_length(sample_rate, min_unit)
+
+        self._program = waveform.compile()
+        self._runs = sample_runs(waveform, sample_rate)
+
+        self.max_abs = self._find_max_abs() if normalize else None
+
+    def _evaluate(self, first, last):
+        # Real part of the samples first..last-1
+        times = np.arange(first, last) * (1.0 / self.sample_rate)
+        return np.real(self._program.evaluate(times))
+
+    def _find_max_abs(self):
+        max_abs = 0
+        for first, last, value in self._runs:
+            if value is not None:
+                max_abs = max(max_abs, abs(np.real(value)))
+                continue
+
+            for block_first in range(first, last, self.block_size):
+                data = self._evaluate(block_first, min(block_first + self.block_size, last))
+                max_abs = max(max_abs, data.max(), -data.min())
+
+        return max_abs
+
+    def __len__(self):
+        # Number of blocks
+        return -(-self.sample_length // self.block_size)
+
+    def __iter__(self):
+        if self.dtype.kind == 'i' and self.max_abs is None:
+            raise ValueError("Integer samples need normalizing.")
+
+        scale = None
+        if self.max_abs:
+            scale = full_scale(self.dtype) / self.max_abs
+
+        for first in range(0, self.sample_length, self.block_size):
+            last = min(first + self.block_size, self.sample_length)
+            block = np.zeros(last - first, dtype=self.dtype)
+
+            evaluated_last = min(last, self.sample_count)
+            if first < evaluated_last:
+                data = self._evaluate(first, evaluated_last)
+                if scale is not None:
+                    data *= scale
+                    if self.dtype.kind == 'i':
+                        limit = full_scale(self.dtype)
+                        np.clip(np.rint(data, out=data), -limit, limit, out=data)
+                np.copyto(block[:evaluated_last - first], data, casting="unsafe")
+
+            yield block
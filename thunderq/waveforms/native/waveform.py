@@ -7,53 +7,204 @@
 # 2. Waveform can be converted to raw data array by using .sample(sample_rate) method.
 # 3. Some operators like "*" have been overloaded, under the premise that doing so won't cause
 #     unnecessary confusion. Therefore, I avoided overloading "+", "-" for this reason.
+# 4. Waveforms are values. Operators return new waveforms and never modify their operands,
+#     and waveforms with the same parameters compare (and hash) equal, so they can be shared
+#     between slices and channels. The parameters of a waveform can't be changed once it is
+#     constructed.
 #
 
+import copy
+import threading
+from bisect import bisect_right
 from textwrap import indent
 import numpy as np
 import matplotlib.pyplot as plt
 
+from thunderq.waveforms.native.sample_cache import default_sample_cache
+
+
+class _WaveformType(type):
+    # Freezes waveforms once they are constructed, see Waveform.__setattr__()
+    def __call__(cls, *args, **kwargs):
+        waveform = super().__call__(*args, **kwargs)
+        waveform.__dict__["_frozen"] = True
+        return waveform
+
+
+class Waveform(metaclass=_WaveformType):
+    # Attributes that fully determine a waveform, see structural_key(). Neither these nor
+    # width and amplitude can be set once the waveform is constructed.
+    _key_attributes = None
 
-class Waveform:
     def __init__(self, width, amplitude):
         self.width = width
         self.amplitude = amplitude
 
+    def __setattr__(self, name, value):
+        if self.__dict__.get("_frozen", False) and \
+                (name in ("width", "amplitude") or name in (self._key_attributes or ())):
+            raise AttributeError(f"Can't set {name} of a {type(self).__name__}, waveforms are "
+                                 f"values. Use its operators to get a changed copy.")
+        super().__setattr__(name, value)
+
+    def _replace(self, **attributes):
+        # A copy of this waveform with the given attributes changed
+        waveform = copy.copy(self)
+        waveform.__dict__.update(attributes)
+        waveform.__dict__.pop("_structural_key", None)
+        return waveform
+
     def at(self, time):
         raise NotImplementedError
 
-    def direct_sample(self, sample_rate, min_unit=16):
-        sample_points = np.arange(0, self.width, 1.0 / sample_rate)
-        padding = []
-        if len(sample_points) % min_unit != 0:
-            padding_len = min_unit - (len(sample_points) % min_unit)
-            padding = [0] * padding_len
+    def at_array(self, times: np.ndarray) -> np.ndarray:
+        # Vectorized version of at(). Subclasses should override this with
+        # a numpy implementation, this scalar loop is only a fallback for
+        # waveforms that don't provide one.
+        return np.array([self.at(time) for time in times])
+
+    def _support_mask(self, times):
+        return (times >= 0) & (times < self.width)
+
+    def _at_array_on_support(self, times, kernel):
+        # Evaluate kernel only at times within [0, width), leave zeros elsewhere.
+        # Built-in waveforms pass their _kernel(t) here, which evaluates the
+        # formula of the waveform assuming every t is within its support.
+        mask = self._support_mask(times)
+        if mask.all():
+            return kernel(times)
+
+        values = kernel(times[mask])
+        result = np.zeros(len(times), dtype=values.dtype)
+        result[mask] = values
+        return result
+
+    def _sample_points(self, sample_rate):
+        return np.arange(0, self.width, 1.0 / sample_rate)
+
+    def sample_length(self, sample_rate, min_unit=1):
+        # Number of samples including padding, without sampling. Equals len(_sample_points())
+        sample_count = max(int(np.ceil(self.width / (1.0 / sample_rate))), 0)
+        return sample_count + self._padding_length(sample_count, min_unit)
+
+    @staticmethod
+    def _padding_length(sample_count, min_unit):
+        if sample_count % min_unit != 0:
+            return min_unit - (sample_count % min_unit)
+        return 0
+
+    def structural_key(self):
+        # A hashable description of this waveform tree: waveforms with equal keys
+        # produce identical samples. Returns None if the waveform can't be described,
+        # which is the case for classes that don't declare their own _key_attributes.
+        # Kept on the waveform once it is frozen, as it can't change anymore.
+        key = self.__dict__.get("_structural_key")
+        if key is None:
+            key = self._structural_key()
+            if key is not None and self.__dict__.get("_frozen", False):
+                self.__dict__["_structural_key"] = key
+        return key
+
+    def _structural_key(self):
+        if type(self).__dict__.get("_key_attributes") is None:
+            return None
+
+        key = [type(self)]
+        for attr in self._key_attributes:
+            value = getattr(self, attr)
+            if isinstance(value, Waveform):
+                value = value.structural_key()
+                if value is None:
+                    return None
+            key.append(value)
+
+        return tuple(key)
+
+    def _cached_sample(self, kind, sample_rate, min_unit, sample_func, cached=True):
+        structural_key = self.structural_key() if cached else None
+        if structural_key is None:
+            return sample_func(sample_rate, min_unit)
+
+        cache_key = (kind, structural_key, sample_rate, min_unit)
+        cached = default_sample_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        result = sample_func(sample_rate, min_unit)
+        default_sample_cache.put(cache_key, result)
+        return result
+
+    def direct_sample(self, sample_rate, min_unit=16, cached=True):
+        # Returned arrays may be shared through the sample cache, hence read-only.
+        # cached: False for waveforms that are rarely sampled twice, e.g. whole channels,
+        #     whose samples would only push the ones of their parts out of the cache.
+        return self._cached_sample("direct", sample_rate, min_unit, self._direct_sample, cached)
+
+    def compile(self):
+        # Lower this waveform tree into a WaveformProgram, see waveforms.native.compiler
+        from thunderq.waveforms.native.compiler import compile_waveform
+        return compile_waveform(self)
 
-        data = np.array([self.at(sample_point) for sample_point in sample_points] + padding)
+    def _direct_sample(self, sample_rate, min_unit):
+        sample_points = self._sample_points(sample_rate)
+        padding_len = self._padding_length(len(sample_points), min_unit)
+
+        program = self.compile()
+        data = np.zeros(len(sample_points) + padding_len, dtype=program.dtype)
+        program.evaluate(sample_points, out=data[:len(sample_points)])
 
         return data
 
-    def normalized_sample(self, sample_rate, min_unit=1):
-        sample_points = np.arange(0, self.width, 1.0 / sample_rate)
-        padding_len = 0
-        if len(sample_points) % min_unit != 0:
-            padding_len = min_unit - (len(sample_points) % min_unit)
+    def normalized_sample(self, sample_rate, min_unit=1, cached=True):
+        # Returned arrays may be shared through the sample cache, hence read-only. See
+        # direct_sample() for cached.
+        return self._cached_sample("normalized", sample_rate, min_unit, self._normalized_sample,
+                                   cached)
 
-        max_abs = 0
-        data = np.zeros(len(sample_points) + padding_len)
-        for i, sample_point in enumerate(sample_points):
-            data[i] = self.at(sample_point)
-            if abs(data[i]) > max_abs:
-                max_abs = abs(data[i])
+    def _normalized_sample(self, sample_rate, min_unit):
+        data = self._real_sample(sample_rate, min_unit)
 
+        max_abs = np.max(np.abs(data)) if len(data) else 0
         if max_abs != 0:
             data = data / max_abs  # Normalize
 
         return data, max_abs
 
+    def sample_range(self, sample_rate, first, last, out=None):
+        # Real part of samples first..last-1, the same values as direct_sample() at these
+        # indices, written into out if given.
+        sample_points = np.arange(first, last) * (1.0 / sample_rate)
+        if out is None:
+            out = np.empty(len(sample_points))
+        return self.compile().evaluate(sample_points, out=out)
+
+    def sample_into(self, buffer, sample_rate, min_unit=1):
+        # Write normalized samples in DAC format into a preallocated buffer, e.g. int16 or
+        # float32, and return the amplitude, see waveforms.native.dac
+        from thunderq.waveforms.native.dac import sample_into
+        return sample_into(self, buffer, sample_rate, min_unit)
+
+    def sample_blocks(self, sample_rate, block_size=1024 ** 2, min_unit=1, normalize=True,
+                      dtype=float):
+        # Iterable of sample blocks with at most block_size samples each, for waveforms too
+        # long to be sampled at once, see waveforms.native.streaming. If normalize, the
+        # blocks are normalized and .max_abs of the returned sampler is the amplitude.
+        from thunderq.waveforms.native.streaming import BlockSampler
+        return BlockSampler(self, sample_rate, block_size, min_unit, normalize, dtype)
+
+    def _real_sample(self, sample_rate, min_unit):
+        # Real part of the samples, padded to min_unit
+        sample_points = self._sample_points(sample_rate)
+        padding_len = self._padding_length(len(sample_points), min_unit)
+
+        data = np.zeros(len(sample_points) + padding_len)
+        self.compile().evaluate(sample_points, out=data[:len(sample_points)])
+
+        return data
+
     def thumbnail_sample(self, sample_points):
         # Used for generating sequence plot
-        return np.array([self.at(time) for time in sample_points])
+        return self.at_array(np.asarray(sample_points))
 
     def plot(self, sample_rate):
         sample_points = np.arange(0, self.width, 1.0 / sample_rate)
@@ -65,31 +216,51 @@ class Waveform:
         return Sequence(self, waveform)
 
     def append_to(self, waveform):
-        return Sequence(waveform, self)
+        if not isinstance(waveform, Waveform):
+            raise TypeError("Expected Waveform")
+        return waveform.concat(self)
 
     def __pos__(self):
         return self
 
     def __neg__(self):
-        self.amplitude = self.amplitude * (-1)
-        return self
+        return self * (-1)
 
     def __abs__(self):
-        self.amplitude = abs(self.amplitude)
-        return self
+        return self._with_amplitude(abs(self.amplitude))
 
     def __mul__(self, other):
         if isinstance(other, Waveform):
             return CarryWave(self, other)
         else:
-            self.amplitude = self.amplitude * other
-        return self
+            return self._with_amplitude(self.amplitude * other)
+
+    def _with_amplitude(self, amplitude):
+        # Copy-on-write: operators never modify their operands
+        return self._replace(amplitude=amplitude)
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, Waveform):
+            return NotImplemented
+
+        key = self.structural_key()
+        return key is not None and key == other.structural_key()
+
+    def __hash__(self):
+        key = self.structural_key()
+        if key is None:
+            return object.__hash__(self)
+        return hash(key)
 
     def __str__(self):
         return f"<Waveform Base Object>"
 
 
 class SumWave(Waveform):
+    _key_attributes = ("wave1", "wave2")
+
     def __init__(self, wave1: Waveform, wave2: Waveform):
         super().__init__(max(wave1.width, wave2.width), 1)
         self.wave1 = wave1
@@ -104,13 +275,17 @@ class SumWave(Waveform):
 
         return self.wave1.at(time) + self.wave2.at(time)
 
+    def at_array(self, times):
+        assert self.amplitude == 1
+
+        return self._at_array_on_support(
+            times, lambda t: self.wave1.at_array(t) + self.wave2.at_array(t))
+
     def __mul__(self, other):
         if isinstance(other, Waveform):
             return CarryWave(self, other)
         else:
-            self.wave1.amplitude = self.wave1.amplitude * other
-            self.wave2.amplitude = self.wave2.amplitude * other
-        return self
+            return SumWave(self.wave1 * other, self.wave2 * other)
 
     def __str__(self):
         return f"<SumWave, width: {self.width:e} s>\n" \
@@ -119,6 +294,8 @@ class SumWave(Waveform):
 
 
 class CarryWave(Waveform):
+    _key_attributes = ("wave1", "wave2")
+
     def __init__(self, wave1: Waveform, wave2: Waveform):
         super().__init__(max(wave1.width, wave2.width), 1)
         self.wave1 = wave1
@@ -133,12 +310,17 @@ class CarryWave(Waveform):
 
         return self.wave1.at(time) * self.wave2.at(time)
 
+    def at_array(self, times):
+        assert self.amplitude == 1
+
+        return self._at_array_on_support(
+            times, lambda t: self.wave1.at_array(t) * self.wave2.at_array(t))
+
     def __mul__(self, other):
         if isinstance(other, Waveform):
             return CarryWave(self, other)
         else:
-            self.wave1.amplitude = self.wave1.amplitude * other
-        return self
+            return CarryWave(self.wave1 * other, self.wave2)
 
     def __str__(self):
         return f"<CarryWave, width: {self.width:e} s>\n" \
@@ -147,71 +329,247 @@ class CarryWave(Waveform):
 
 
 class Sequence(Waveform):
+    # Sequences are append-friendly: a sequence created by concat() shares its
+    # segment list and start-offset table with the sequence it was created
+    # from, and only holds the number of segments that belong to it. As long
+    # as a sequence is the longest view of its shared list, concatenating to
+    # it appends in place, so building a sequence of N segments by repeated
+    # concat() costs O(N) in total. Concatenating to an older (shorter) view
+    # copies its own prefix first, which keeps every view persistent.
+    _append_lock = threading.Lock()
+    # Frozen like the key attributes of other waveforms, see structural_key()
+    _key_attributes = ("_segments", "_start_at", "_length")
+
     def __init__(self, *argv):
         super().__init__(0, 0)
-        self.sequence = []
-        self.each_waveform_start_at = None
+        self._segments = []
+        self._start_at = None
+        self._length = 0
 
         for arg in argv:
             if isinstance(arg, Sequence):
-                self.sequence.extend(arg.sequence)
+                self._segments.extend(arg.sequence)
             elif isinstance(arg, Waveform):
-                self.sequence.append(arg)
+                self._segments.append(arg)
             else:
                 raise TypeError("Expected Waveform")
 
         self._analysis_each_waveform_start_at()
 
+    @classmethod
+    def from_segments(cls, segments, start_at):
+        # Build a sequence with the given start offsets (one more than segments), instead of
+        # summing up segment widths, which may round differently.
+        assert len(start_at) == len(segments) + 1
+        return cls._view(list(segments), list(start_at), len(segments))
+
+    @classmethod
+    def _view(cls, segments, start_at, length):
+        # A sequence of the first length segments of the given lists, which it may share
+        sequence = cls()
+        # Still constructing, the sequence isn't handed out yet
+        sequence.__dict__.update(_segments=segments, _start_at=start_at, _length=length,
+                                 width=start_at[length])
+        return sequence
+
     def _analysis_each_waveform_start_at(self):
-        self.each_waveform_start_at = [0]
+        self._start_at = [0]
         time = 0
-        for waveform in self.sequence:
+        for waveform in self._segments:
             time += waveform.width
-            self.each_waveform_start_at.append(time)
+            self._start_at.append(time)
+        self._length = len(self._segments)
         self.width = time
 
+    @property
+    def sequence(self):
+        return self._segments[:self._length]
+
+    @property
+    def each_waveform_start_at(self):
+        return self._start_at[:self._length + 1]
+
+    def _structural_key(self):
+        keys = []
+        for waveform in self.sequence:
+            key = waveform.structural_key()
+            if key is None:
+                return None
+            keys.append(key)
+
+        # Offsets are part of the key, as from_segments() takes any
+        return Sequence, tuple(keys), tuple(self.each_waveform_start_at)
+
+    def concat(self, waveform):
+        if isinstance(waveform, Sequence):
+            return self._extended(waveform.sequence)
+        elif isinstance(waveform, Waveform):
+            return self._extended([waveform])
+        else:
+            raise TypeError("Expected Waveform")
+
+    def _extended(self, waveforms):
+        with Sequence._append_lock:
+            if self._length == len(self._segments):
+                segments, start_at = self._segments, self._start_at
+            else:
+                segments = self._segments[:self._length]
+                start_at = self._start_at[:self._length + 1]
+
+            time = start_at[-1]
+            for waveform in waveforms:
+                time += waveform.width
+                segments.append(waveform)
+                start_at.append(time)
+
+            extended = Sequence._view(segments, start_at, len(segments))
+
+        return extended
+
+    def __mul__(self, other):
+        if isinstance(other, Waveform):
+            return CarryWave(self, other)
+        else:
+            return Sequence.from_segments([waveform * other for waveform in self.sequence],
+                                          self.each_waveform_start_at)
+
+    def __abs__(self):
+        return Sequence.from_segments([abs(waveform) for waveform in self.sequence],
+                                      self.each_waveform_start_at)
+
+    def _iq_parts(self, sample_rate):
+        # [(i, first sample)] of the segments that are the I or Q part (Real or Imag) of a
+        # CalibratedIQ, and start on a sample. Sampling copies these from the pair sampled by
+        # CalibratedIQ.sample_pair(), which the channel of the other part shares.
+        parts = []
+        for i, segment in enumerate(self.sequence):
+            if type(segment) in (Real, Imag) and type(segment.complex_waveform) is CalibratedIQ:
+                first_sample = self._start_at[i] * sample_rate
+                if abs(first_sample - round(first_sample)) <= 1e-6:
+                    parts.append((i, int(round(first_sample))))
+        return parts
+
+    def _program_without(self, parts):
+        # Program of this sequence with the segments of parts left blank
+        segments = self.sequence
+        for i, _ in parts:
+            segments[i] = Blank(segments[i].width)
+        return Sequence.from_segments(segments, self.each_waveform_start_at).compile()
+
+    def _sample_with_parts(self, sample_rate, first, last, out, parts, program):
+        # Samples first..last-1 into out, the segments of parts copied from their pair
+        times = np.arange(first, last) * (1.0 / sample_rate)
+        program.evaluate(times, out=out)
+
+        for i, first_sample in parts:
+            segment = self._segments[i]
+            start, end = self._start_at[i], self._start_at[i + 1]
+            lo, hi = np.searchsorted(times, (start, end), side="left")
+            pair = segment.complex_waveform.sample_pair(sample_rate, min_unit=1)
+            data = pair[0] if type(segment) is Real else pair[1]
+
+            # Sample lo is data[lo + shift]. Samples the pair doesn't cover, if it rounds
+            # differently at the edges, are evaluated.
+            shift = first - first_sample
+            copy_lo = min(max(lo, -shift), hi)
+            copy_hi = max(min(hi, len(data) - shift), copy_lo)
+            out[copy_lo:copy_hi] = data[copy_lo + shift:copy_hi + shift]
+            for edge_lo, edge_hi in ((lo, copy_lo), (copy_hi, hi)):
+                if edge_lo < edge_hi:
+                    out[edge_lo:edge_hi] = segment.at_array(times[edge_lo:edge_hi] - start)
+
+        return out
+
+    def _direct_sample(self, sample_rate, min_unit):
+        parts = self._iq_parts(sample_rate)
+        if not parts:
+            return super()._direct_sample(sample_rate, min_unit)
+
+        program = self._program_without(parts)
+        sample_count = self.sample_length(sample_rate)
+        data = np.zeros(self.sample_length(sample_rate, min_unit), dtype=program.dtype)
+        self._sample_with_parts(sample_rate, 0, sample_count, data[:sample_count], parts, program)
+        return data
+
+    def _real_sample(self, sample_rate, min_unit):
+        sample_count = self.sample_length(sample_rate)
+        data = np.zeros(self.sample_length(sample_rate, min_unit))
+        self.sample_range(sample_rate, 0, sample_count, out=data[:sample_count])
+        return data
+
+    def sample_range(self, sample_rate, first, last, out=None):
+        parts = self._iq_parts(sample_rate)
+        if not parts:
+            return super().sample_range(sample_rate, first, last, out)
+
+        if out is None:
+            out = np.empty(last - first)
+        return self._sample_with_parts(sample_rate, first, last, out, parts,
+                                       self._program_without(parts))
+
     def at(self, time):
-        if len(self.sequence) == 0:
+        if self._length == 0:
             return 0
 
         if not 0 <= time < self.width:
             return 0
 
-        for i in range(len(self.each_waveform_start_at) - 1):
-            start_at = self.each_waveform_start_at[i]
-            if self.each_waveform_start_at[i] <= time < self.each_waveform_start_at[i + 1]:
-                return self.sequence[i].at(time - start_at)
+        i = bisect_right(self._start_at, time, 0, self._length + 1) - 1
+        return self._segments[i].at(time - self._start_at[i])
 
-        return 0
+    def at_array(self, times):
+        times = np.asarray(times)
+        order = None
+        if len(times) > 1 and (times[1:] < times[:-1]).any():
+            order = np.argsort(times, kind="stable")
+            times = times[order]
 
-    def thumbnail_sample(self, sample_points):
-        result = np.zeros(len(sample_points))
-
-        sample_pos = 0
-        for i in range(len(self.each_waveform_start_at) - 1):
-            start_at = self.each_waveform_start_at[i]
-            next_start_at = self.each_waveform_start_at[i + 1]
-
-            while sample_points[sample_pos] < start_at:
-                result[sample_pos] = 0
-                sample_pos += 1
-            if sample_pos == len(sample_points) - 1:
-                break
-
-            if sample_points[sample_pos] < next_start_at:
-                while sample_points[sample_pos] < next_start_at:
-                    result[sample_pos] = self.sequence[i].at(sample_points[sample_pos] - start_at)
-                    sample_pos += 1
-                    if sample_pos == len(sample_points) - 1:
-                        break
+        result = self._sample_sorted(times)
+
+        if order is not None:
+            unsorted = np.empty_like(result)
+            unsorted[order] = result
+            result = unsorted
+
+        return result
+
+    def _sample_sorted(self, times):
+        # Locate the sample index range of each segment once, then fill the
+        # output buffer segment by segment.
+        result = np.zeros(len(times))
+        start_at = self.each_waveform_start_at
+        bounds = np.searchsorted(times, start_at, side="left")
+
+        for i, waveform in enumerate(self.sequence):
+            lo, hi = bounds[i], bounds[i + 1]
+            if lo == hi or type(waveform) is Blank:
+                continue
+
+            if type(waveform) in (DC, Blank):
+                values = waveform.value()
             else:
-                # If some waveforms has width that is less than the resolution of sample_rate:
-                result[sample_pos] = self.sequence[i].at(
-                    (start_at + next_start_at) / 2 - start_at)
-                sample_pos += 1
+                values = waveform.at_array(times[lo:hi] - start_at[i])
+            if np.iscomplexobj(values) and not np.iscomplexobj(result):
+                result = result.astype(complex)
+            result[lo:hi] = values
 
-            if sample_pos == len(sample_points) - 1:
-                break
+        return result
+
+    def thumbnail_sample(self, sample_points):
+        sample_points = np.asarray(sample_points)
+        result = self.at_array(sample_points)
+
+        each_waveform_start_at = self.each_waveform_start_at
+        for i, waveform in enumerate(self.sequence):
+            if waveform.width <= 0:
+                continue
+            start_at = each_waveform_start_at[i]
+            next_start_at = each_waveform_start_at[i + 1]
+
+            pos = np.searchsorted(sample_points, start_at)
+            if pos < len(sample_points) and sample_points[pos] >= next_start_at:
+                # If some waveforms has width that is less than the resolution of sample_rate:
+                result[pos] = waveform.at((start_at + next_start_at) / 2 - start_at)
 
         return result
 
@@ -224,6 +582,8 @@ class Sequence(Waveform):
 
 
 class Sin(Waveform):
+    _key_attributes = ("width", "amplitude", "omega", "phi")
+
     def __init__(self, width, amplitude, omega=0, phi=0):
         super().__init__(width, amplitude)
         self.omega = omega
@@ -232,11 +592,19 @@ class Sin(Waveform):
     def at(self, time):
         return self.amplitude * np.sin(self.omega * time + self.phi) if 0 <= time < self.width else 0
 
+    def at_array(self, times):
+        return self._at_array_on_support(times, self._kernel)
+
+    def _kernel(self, t):
+        return self.amplitude * np.sin(self.omega * t + self.phi)
+
     def __str__(self):
         return f"<Sin, amplitude:{self.amplitude} V, width: {self.width:e} s>"
 
 
 class Cos(Waveform):
+    _key_attributes = ("width", "amplitude", "omega", "phi")
+
     def __init__(self, width, amplitude, omega=0, phi=0):
         super().__init__(width, amplitude)
         self.omega = omega
@@ -245,11 +613,19 @@ class Cos(Waveform):
     def at(self, time):
         return self.amplitude * np.cos(self.omega * time + self.phi) if 0 <= time < self.width else 0
 
+    def at_array(self, times):
+        return self._at_array_on_support(times, self._kernel)
+
+    def _kernel(self, t):
+        return self.amplitude * np.cos(self.omega * t + self.phi)
+
     def __str__(self):
         return f"<Cos, amplitude:{self.amplitude} V, width: {self.width:e} s>"
 
 
 class ComplexExp(Waveform):
+    _key_attributes = ("width", "amplitude", "omega", "phi")
+
     def __init__(self, width, amplitude, omega=0, phi=0):
         super().__init__(width, amplitude)
         self.omega = omega
@@ -259,29 +635,49 @@ class ComplexExp(Waveform):
         return self.amplitude * np.cos(self.omega * time + self.phi) + 1j * np.sin(self.omega * time + self.phi)\
             if 0 <= time < self.width else 0
 
+    def at_array(self, times):
+        return self._at_array_on_support(times, self._kernel)
+
+    def _kernel(self, t):
+        return self.amplitude * np.cos(self.omega * t + self.phi) + 1j * np.sin(self.omega * t + self.phi)
+
     def __str__(self):
         return f"<ComplexExp, amplitude:{self.amplitude} V, width: {self.width:e} s>"
 
 
 class DC(Waveform):
+    _key_attributes = ("width", "amplitude", "complex_phi")
+
     def __init__(self, width, offset, complex_phi=0):
         super().__init__(width, offset)
         self.complex_phi = complex_phi
 
-    def at(self, time):
-        if not 0 <= time < self.width:
-            return 0
-
+    def value(self):
         if self.complex_phi != 0:
             return self.amplitude * np.exp(1j*self.complex_phi)
         else:
             return self.amplitude
 
+    def at(self, time):
+        if not 0 <= time < self.width:
+            return 0
+
+        return self.value()
+
+    def at_array(self, times):
+        return self._at_array_on_support(times, self._kernel)
+
+    def _kernel(self, t):
+        value = self.value()
+        return np.full(len(t), value, dtype=np.result_type(value, float))
+
     def __str__(self):
         return f"<DC, offset:{self.amplitude} V, width: {self.width:e} s>"
 
 
 class Blank(DC):
+    _key_attributes = ("width",)
+
     def __init__(self, width=0):
         super().__init__(width, 0, 0)
 
@@ -290,6 +686,8 @@ class Blank(DC):
 
 
 class Gaussian(Waveform):
+    _key_attributes = ("width", "amplitude")
+
     def __init__(self, width=0, amplitude=1):
         super().__init__(width, amplitude)
 
@@ -301,6 +699,12 @@ class Gaussian(Waveform):
 
         return self.amplitude * np.exp(-0.5 * ((time - 0.5 * self.width) / self.sigma) ** 2)
 
+    def at_array(self, times):
+        return self._at_array_on_support(times, self._kernel)
+
+    def _kernel(self, t):
+        return self.amplitude * np.exp(-0.5 * ((t - 0.5 * self.width) / self.sigma) ** 2)
+
     def __str__(self):
         return f"<Gaussian, amplitude:{self.amplitude} V, width: {self.width:e} s>"
 
@@ -311,6 +715,8 @@ class CalibratedIQ(Waveform):
     # WARNING: This class doesn't deal with channel voltage offset. You should manually set it.
     #          since it should be applied to a channel in the entire time span to compensate the
     #          LO leakage.
+    _key_attributes = ("carry_IQ", "left_shift_I", "left_shift_Q", "scale_I", "scale_Q")
+
     def __init__(self,
                  carry_freq,
                  I_waveform: Waveform=None,
@@ -376,6 +782,44 @@ class CalibratedIQ(Waveform):
 
         return I_value + 1j * Q_value
 
+    def at_array(self, times):
+        I_value, Q_value = self.at_array_pair(times)
+        return I_value + 1j * Q_value
+
+    def at_array_pair(self, times):
+        # I and Q values as two real arrays. carry_IQ is evaluated only once if I and Q
+        # share the same time shift.
+        times = np.asarray(times)
+        carry_IQ = self.carry_IQ.at_array(times + self.left_shift_I)
+        I_value = np.real(carry_IQ) * self.scale_I
+        if self.left_shift_Q != self.left_shift_I:
+            carry_IQ = self.carry_IQ.at_array(times + self.left_shift_Q)
+        Q_value = np.imag(carry_IQ) * self.scale_Q
+
+        return I_value, Q_value
+
+    def sample_pair(self, sample_rate, min_unit=16):
+        # Sampled (I, Q) arrays, padded to min_unit. Real and Imag of this waveform use
+        # this pair, so the I and Q channels share a single pass through the sample cache.
+        return self._cached_sample("iq_pair", sample_rate, min_unit, self._sample_pair)
+
+    def _sample_pair(self, sample_rate, min_unit):
+        sample_points = self._sample_points(sample_rate)
+        sample_count = len(sample_points)
+        padding_len = self._padding_length(sample_count, min_unit)
+
+        program = self.carry_IQ.compile()
+        I_data = np.zeros(sample_count + padding_len)
+        Q_data = np.zeros(sample_count + padding_len)
+
+        carry_IQ = program.evaluate(sample_points + self.left_shift_I)
+        np.multiply(np.real(carry_IQ), self.scale_I, out=I_data[:sample_count])
+        if self.left_shift_Q != self.left_shift_I:
+            carry_IQ = program.evaluate(sample_points + self.left_shift_Q)
+        np.multiply(np.imag(carry_IQ), self.scale_Q, out=Q_data[:sample_count])
+
+        return I_data, Q_data
+
     def __mul__(self, other):
         raise TypeError("It's unwise to adjust the amplitude of a calibrated waveforms.")
 
@@ -385,6 +829,8 @@ class CalibratedIQ(Waveform):
 
 
 class Real(Waveform):
+    _key_attributes = ("complex_waveform",)
+
     def __init__(self, complex_waveform: Waveform):
         super().__init__(complex_waveform.width, complex_waveform.amplitude)
         self.complex_waveform = complex_waveform
@@ -392,14 +838,27 @@ class Real(Waveform):
     def at(self, time):
         return self.complex_waveform.at(time).real
 
+    def at_array(self, times):
+        return np.real(self.complex_waveform.at_array(times))
+
     def __mul__(self, other):
         return self.complex_waveform * other
 
+    def _real_sample(self, sample_rate, min_unit):
+        if type(self.complex_waveform) is CalibratedIQ:
+            return self.complex_waveform.sample_pair(sample_rate, min_unit)[0]
+        return super()._real_sample(sample_rate, min_unit)
+
+    def _direct_sample(self, sample_rate, min_unit):
+        return self._real_sample(sample_rate, min_unit)
+
     def __str__(self):
         return f"<Real of {self.complex_waveform}>"
 
 
 class Imag(Waveform):
+    _key_attributes = ("complex_waveform",)
+
     def __init__(self, complex_waveform: Waveform):
         super().__init__(complex_waveform.width, complex_waveform.amplitude)
         self.complex_waveform = complex_waveform
@@ -407,8 +866,19 @@ class Imag(Waveform):
     def at(self, time):
         return self.complex_waveform.at(time).imag
 
+    def at_array(self, times):
+        return np.imag(self.complex_waveform.at_array(times))
+
     def __mul__(self, other):
         return self.complex_waveform * other
 
+    def _real_sample(self, sample_rate, min_unit):
+        if type(self.complex_waveform) is CalibratedIQ:
+            return self.complex_waveform.sample_pair(sample_rate, min_unit)[1]
+        return super()._real_sample(sample_rate, min_unit)
+
+    def _direct_sample(self, sample_rate, min_unit):
+        return self._real_sample(sample_rate, min_unit)
+
     def __str__(self):
         return f"<Imag of {self.complex_waveform}>"